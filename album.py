@@ -20,3 +20,6 @@ class Album(object):
 
     def __eq__(self, other):
         return self.uuid == other.uuid
+
+    def __ne__(self, other):
+        return not self == other
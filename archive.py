@@ -0,0 +1,221 @@
+__author__ = 'namezys'
+
+import abc
+import os
+import struct
+import sys
+import tarfile
+import time
+import zipfile
+import zlib
+
+TAR = "tar"
+ZIP = "zip"
+FORMATS = (TAR, ZIP)
+
+STDOUT = "-"
+
+BUFFER_SIZE = 1 << 20
+
+DIR_MODE = 0755
+
+# CRC and sizes of file are written after its data
+_DATA_DESCRIPTOR = 0x08
+
+
+def guess_format(path):
+    """Guess format of archive by extension of path, tar is default"""
+    return ZIP if path.lower().endswith(".zip") else TAR
+
+
+class _Output(object):
+    """Write-only stream which counts written bytes, so zip can be written to pipe"""
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.offset = 0
+
+    def write(self, data):
+        self.fileobj.write(data)
+        self.offset += len(data)
+
+    def tell(self):
+        return self.offset
+
+    def flush(self):
+        self.fileobj.flush()
+
+
+class _AtomicFile(object):
+    """File which is written to temp path and renamed on close"""
+
+    def __init__(self, path):
+        self.path = path
+        self.tmp_path = path + ".tmp"
+        self.file = open(self.tmp_path, "wb", BUFFER_SIZE)
+
+    def write(self, data):
+        self.file.write(data)
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+        os.rename(self.tmp_path, self.path)
+
+    def discard(self):
+        """Close file and remove it, previous file is kept"""
+        self.file.close()
+        os.remove(self.tmp_path)
+
+
+class Archive(object):
+    """Archive which is written sequentially without seeks
+
+    Files are read by large blocks and stored as is, so output can be pipe.
+
+    :ivar files: number of added files
+    :ivar size: size of added files
+    """
+
+    __metaclass__ = abc.ABCMeta
+
+    def __init__(self, fileobj, close_fileobj=False):
+        """
+        :param close_fileobj: close or discard file object with archive, otherwise it's only flushed
+        """
+        self.fileobj = fileobj
+        self.close_fileobj = close_fileobj
+        self.files = 0
+        self.size = 0
+
+    @abc.abstractmethod
+    def add_dir(self, name):
+        pass
+
+    @abc.abstractmethod
+    def add_file(self, src, name):
+        pass
+
+    @abc.abstractmethod
+    def _finish(self):
+        pass
+
+    def close(self):
+        self._finish()
+        if self.close_fileobj:
+            self.fileobj.close()
+        else:
+            self.fileobj.flush()
+
+    def abort(self):
+        """Stop writing of unfinished archive, its file is removed"""
+        if self.close_fileobj:
+            self.fileobj.discard()
+
+
+class TarArchive(Archive):
+    def __init__(self, fileobj, close_fileobj=False):
+        Archive.__init__(self, fileobj, close_fileobj)
+        # stream of tarfile joins small writes by copy of its buffer, so it's kept small and output is buffered
+        self.tar = tarfile.open(fileobj=fileobj, mode="w|")
+
+    def add_dir(self, name):
+        info = tarfile.TarInfo(name)
+        info.type = tarfile.DIRTYPE
+        info.mode = DIR_MODE
+        info.mtime = time.time()
+        self.tar.addfile(info)
+
+    def add_file(self, src, name):
+        with open(src, "rb", BUFFER_SIZE) as src_file:
+            info = self.tar.gettarinfo(arcname=name, fileobj=src_file)
+            self.tar.addfile(info, src_file)
+        self.files += 1
+        self.size += info.size
+
+    def _finish(self):
+        self.tar.close()
+
+    def abort(self):
+        # stream isn't finished on deletion
+        self.tar.closed = self.tar.fileobj.closed = True
+        Archive.abort(self)
+
+
+class ZipArchive(Archive):
+    """Zip archive without compression
+
+    CRC of each file is written after its data, so file is read once and output isn't seeked back.
+    """
+
+    def __init__(self, fileobj, close_fileobj=False):
+        Archive.__init__(self, fileobj, close_fileobj)
+        self.output = _Output(fileobj)
+        self.zip = zipfile.ZipFile(self.output, "w", zipfile.ZIP_STORED, allowZip64=True)
+
+    def _add(self, info):
+        info.header_offset = self.output.tell()
+        self.zip.filelist.append(info)
+        self.zip.NameToInfo[info.filename] = info
+
+    def add_dir(self, name):
+        info = zipfile.ZipInfo(name.rstrip("/") + "/", time.localtime()[:6])
+        info.external_attr = ((0040000 | DIR_MODE) << 16) | 0x10
+        info.CRC = info.file_size = info.compress_size = 0
+        self._add(info)
+        self.output.write(info.FileHeader())
+
+    def add_file(self, src, name):
+        with open(src, "rb", BUFFER_SIZE) as src_file:
+            stat = os.fstat(src_file.fileno())
+            # size is checked before header, so archive isn't left with part of file
+            if stat.st_size > zipfile.ZIP64_LIMIT:
+                raise zipfile.LargeZipFile("%s is too large for zip" % src)
+            info = zipfile.ZipInfo(name, time.localtime(stat.st_mtime)[:6])
+            info.external_attr = (stat.st_mode & 0xFFFF) << 16
+            info.flag_bits |= _DATA_DESCRIPTOR
+            self._add(info)
+            self.output.write(info.FileHeader(zip64=False))
+            crc = 0
+            size = 0
+            while True:
+                data = src_file.read(BUFFER_SIZE)
+                if not data:
+                    break
+                crc = zlib.crc32(data, crc)
+                size += len(data)
+                self.output.write(data)
+        info.CRC = crc & 0xffffffff
+        info.file_size = info.compress_size = size
+        self.output.write(struct.pack("<4sLLL", "PK\x07\x08", info.CRC, size, size))
+        self.files += 1
+        self.size += size
+
+    def _finish(self):
+        self.zip.close()
+
+    def abort(self):
+        # central directory isn't written on deletion
+        self.zip.fp = None
+        Archive.abort(self)
+
+
+ARCHIVES = {
+    TAR: TarArchive,
+    ZIP: ZipArchive,
+}
+
+
+def open_archive(path, archive_format=None):
+    """Open archive to write it to file or to stdout if path is "-"
+
+    File is written to temp path and it's renamed on close, so previous archive is kept until new one is done.
+
+    :param archive_format: tar or zip (default is guessed by extension of path)
+    """
+    archive_class = ARCHIVES[archive_format or guess_format(path)]
+    if path == STDOUT:
+        return archive_class(sys.stdout)
+    return archive_class(_AtomicFile(path), close_fileobj=True)
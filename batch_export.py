@@ -0,0 +1,244 @@
+__author__ = 'namezys'
+
+import json
+import logging
+import multiprocessing
+import os
+import time
+import traceback
+
+from argparse import ArgumentParser
+
+from copier import LINK_MODES, COPY
+from create_albumdata import AlbumData, peak_memory
+from create_thumbnails import SaveThumbnails
+from plist_writer import WRITERS, XML
+from snapshot import DEFAULT_CACHE_DIR
+
+logger = logging.getLogger(__name__)
+
+DESCR = "Create albumdata and thumbnails for many photos libraries in parallel"
+
+ALBUMDATA = "AlbumData.xml"
+THUMBNAILS = "thumbnails"
+
+OK = "ok"
+FAILED = "failed"
+CRASHED = "crashed"
+TIMEOUT = "timeout"
+
+POLL_INTERVAL = 0.1
+
+
+def load_manifest(manifest_path):
+    """Read list of jobs
+
+    Manifest is json list of objects with "path" of library and optional "albumdata" and "thumbnails" outputs.
+    Relative paths are relative to directory of manifest.
+    """
+    with open(manifest_path) as manifest_file:
+        jobs = json.load(manifest_file)
+    base = os.path.dirname(os.path.abspath(manifest_path))
+    for job in jobs:
+        for key in ("path", "albumdata", "thumbnails"):
+            if job.get(key):
+                job[key] = os.path.join(base, job[key])
+    return jobs
+
+
+def output_jobs(paths, output, albumdata=True, thumbnails=True):
+    """Make jobs which write outputs of each library into its own directory of `output`"""
+    jobs = []
+    for path in paths:
+        name = os.path.splitext(os.path.basename(os.path.normpath(path)))[0]
+        job_output = os.path.join(output, name)
+        jobs.append({
+            "path": path,
+            "albumdata": os.path.join(job_output, ALBUMDATA) if albumdata else None,
+            "thumbnails": os.path.join(job_output, THUMBNAILS) if thumbnails else None,
+        })
+    return jobs
+
+
+def export(job, options):
+    """Create albumdata and thumbnails of one library
+
+    :return: dict of statistics
+    """
+    start = time.time()
+    stats = dict()
+    if job.get("albumdata"):
+        xml_path = job["albumdata"]
+        if not os.path.exists(os.path.dirname(xml_path)):
+            os.makedirs(os.path.dirname(xml_path))
+        album_data = AlbumData(job["path"], disable_rolls=options["disable_rolls"],
+                               disable_rating=options["disable_rating"], tmp_db=options["tmp_db"],
+                               gen_caption=options["generate_caption"], output_format=options["format"],
+                               cache_dir=options["cache_dir"])
+        stats["albumdata_written"] = album_data.update(xml_path, xml_path + ".state", full=options["full"])
+        stats["photos"] = len(album_data.photos)
+    if job.get("thumbnails"):
+        thumbnails = SaveThumbnails(job["thumbnails"], job["path"], options["tmp_db"], jobs=options["copy_jobs"],
+                                    link=options["link"], cache_dir=options["cache_dir"])
+        thumbnails.build()
+        stats["photos"] = len(thumbnails.photos)
+    stats["time"] = time.time() - start
+    stats["peak_memory"] = peak_memory()
+    return stats
+
+
+def _run(job, options, conn):
+    try:
+        result = dict(export(job, options), status=OK)
+    except Exception as e:
+        logger.error("Export of %s failed: %s", job["path"], e)
+        result = {"status": FAILED, "error": "%s: %s" % (type(e).__name__, e), "traceback": traceback.format_exc()}
+    conn.send(result)
+    conn.close()
+
+
+class BatchExport(object):
+    """Export many libraries by separate processes
+
+    Failure or crash of one library doesn't stop others. Process which runs longer than timeout is terminated.
+
+    :ivar results: list of results in the same order as jobs
+    """
+
+    def __init__(self, jobs, options, processes=None, timeout=None):
+        """
+        :param jobs: list of dict with "path" of library and "albumdata" and "thumbnails" outputs
+        :param options: dict of options of `export`
+        :param processes: number of parallel processes (default is number of CPUs)
+        :param timeout: seconds to export one library
+        """
+        self.jobs = jobs
+        self.options = options
+        self.processes = processes or multiprocessing.cpu_count()
+        self.timeout = timeout
+        self.results = [None] * len(jobs)
+
+    def run(self):
+        start = time.time()
+        pending = list(enumerate(self.jobs))
+        pending.reverse()
+        running = []
+        while pending or running:
+            while pending and len(running) < self.processes:
+                running.append(self._start(*pending.pop()))
+            time.sleep(POLL_INTERVAL)
+            running = [r for r in running if not self._check(*r)]
+        logger.info("Exported %s libraries in %.1f s", len(self.jobs), time.time() - start)
+        return self.results
+
+    def _start(self, index, job):
+        logger.info("Export %s", job["path"])
+        conn, child_conn = multiprocessing.Pipe(False)
+        process = multiprocessing.Process(target=_run, args=(job, self.options, child_conn),
+                                          name=os.path.basename(os.path.normpath(job["path"])))
+        process.start()
+        child_conn.close()
+        return index, process, conn, time.time()
+
+    def _check(self, index, process, conn, start):
+        """Collect result of process if it's finished
+
+        :return: True if process is finished
+        """
+        result = None
+        if not conn.poll() and process.is_alive():
+            if self.timeout is None or time.time() - start < self.timeout:
+                return False
+            logger.error("Export of %s is timed out", self.jobs[index]["path"])
+            process.terminate()
+            result = {"status": TIMEOUT, "error": "Timed out after %.0f s" % self.timeout}
+        # result can be sent between poll and exit of process, so pipe is polled again
+        elif conn.poll():
+            try:
+                result = conn.recv()
+            except EOFError:
+                pass
+        process.join()
+        conn.close()
+        if result is None:
+            result = {"status": CRASHED, "error": "Exit code %s" % process.exitcode}
+        result["path"] = self.jobs[index]["path"]
+        result.setdefault("time", time.time() - start)
+        self.results[index] = result
+        logger.info("Export of %s: %s in %.1f s", result["path"], result["status"], result["time"])
+        return True
+
+
+def print_summary(results):
+    print "%-40s %-8s %8s %8s %9s  %s" % ("Library", "Status", "Photos", "Time", "Memory", "Error")
+    for result in results:
+        memory = result.get("peak_memory")
+        print "%-40s %-8s %8s %8.1f %9s  %s" % (
+            result["path"][-40:], result["status"], result.get("photos", ""), result["time"],
+            "%.1f MB" % (memory / 1048576.0) if memory else "", result.get("error", ""))
+    failed = sum(1 for r in results if r["status"] != OK)
+    print "Total: %d, ok: %d, failed: %d" % (len(results), len(results) - failed, failed)
+
+
+def main():
+    parser = ArgumentParser(description=DESCR)
+    parser.add_argument("--manifest", "-m", help="Json list of libraries and outputs")
+    parser.add_argument("--output", "-o", help="Directory to write outputs of each library given by arguments")
+    parser.add_argument("--no-albumdata", action="store_true", help="Don't create albumdata of libraries")
+    parser.add_argument("--no-thumbnails", action="store_true", help="Don't create thumbnails of libraries")
+    parser.add_argument("--processes", "-j", type=int, help="Number of parallel libraries (default is number of CPUs)")
+    parser.add_argument("--timeout", type=float, help="Seconds to export one library")
+    parser.add_argument("--report", help="Path to write json report")
+
+    parser.add_argument("--disable-rolls", action="store_true", help="Disable iPhoto events")
+    parser.add_argument("--disable-rating", action="store_true", help="Disable 5-stars iPhoto rating for favorite")
+    parser.add_argument("--generate-caption", action="store_true", help="Generate caption like photo_id")
+    parser.add_argument("--format", choices=sorted(WRITERS), default=XML, help="Format of plist")
+    parser.add_argument("--full", action="store_true", help="Ignore state of previous run and write everything")
+    parser.add_argument("--copy-jobs", type=int, default=1, help="Number of parallel copies of each library")
+    parser.add_argument("--link", choices=LINK_MODES, default=COPY,
+                        help="Create hard links or reflinks instead of copies if it's possible")
+    parser.add_argument("--tmp-db", action="store_true", help="Create temp copy of db if it is locked")
+    parser.add_argument("--cache-dir", default=DEFAULT_CACHE_DIR, help="Directory to keep snapshot of library")
+    parser.add_argument("--no-cache", action="store_true", help="Read databases without snapshot of library")
+
+    parser.add_argument("--log-level",
+                        choices=['INFO', 'WARNING', 'DEBUG', 'ERROR', 'CRITICAL'],
+                        help="Logging level",
+                        default='WARNING')
+    parser.add_argument("libraries", nargs="*", help="Paths to photos directories")
+
+    args = parser.parse_args()
+    logging.basicConfig(format='%(processName)s: %(message)s',
+                        level=getattr(logging, args.log_level))
+
+    jobs = load_manifest(args.manifest) if args.manifest else []
+    if args.libraries:
+        if not args.output:
+            parser.error("--output is required for libraries given by arguments")
+        jobs += output_jobs(args.libraries, args.output, not args.no_albumdata, not args.no_thumbnails)
+    if not jobs:
+        parser.error("No libraries to export")
+
+    options = {
+        "disable_rolls": args.disable_rolls,
+        "disable_rating": args.disable_rating,
+        "generate_caption": args.generate_caption,
+        "format": args.format,
+        "full": args.full,
+        "copy_jobs": args.copy_jobs,
+        "link": args.link,
+        "tmp_db": args.tmp_db,
+        "cache_dir": None if args.no_cache else args.cache_dir,
+    }
+    results = BatchExport(jobs, options, processes=args.processes, timeout=args.timeout).run()
+    print_summary(results)
+    if args.report:
+        with open(args.report, "w") as report_file:
+            json.dump(results, report_file, indent=2)
+    if any(r["status"] != OK for r in results):
+        exit(1)
+
+
+if __name__ == "__main__":
+    main()
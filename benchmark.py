@@ -0,0 +1,437 @@
+__author__ = 'namezys'
+
+import distutils.spawn
+import httplib
+import json
+import logging
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from argparse import ArgumentParser
+
+from synthetic_library import SyntheticLibrary, DEPTH, FANOUT
+
+logger = logging.getLogger(__name__)
+
+DESCR = "Benchmark entry points on photos library"
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+STARTUP_CODE = """import time
+start = time.time()
+%s
+print time.time() - start
+"""
+
+STARTUP = [
+    ("create_albumdata", "from create_albumdata import AlbumData\n"
+                         "AlbumData(%(path)r)"),
+    ("create_thumbnails", "from create_thumbnails import SaveThumbnails\n"
+                          "SaveThumbnails(%(output)r, %(path)r, True)"),
+    ("photos_tool", "import photos_tool\n"
+                    "photos_tool.Library(%(db_path)r, True)"),
+]
+
+
+PHOTOS_CODE = """import time
+from create_albumdata import peak_memory
+from library import Library
+library = Library(%(db_path)r, False)
+library.library_db
+memory = peak_memory()
+start = time.time()
+photos = %(fetch)s
+print time.time() - start, peak_memory() - memory
+"""
+
+PHOTOS = [
+    ("dict", "dict((p.id, p) for p in library.fetch_photos())"),
+    ("table", "library.fetch_photo_table()"),
+]
+
+ALBUM_LOOKUP_CODE = """import time
+from library import Library
+library = Library(%(db_path)r, False)
+library.library_db
+start = time.time()
+library.fetch_album_photo_ids()
+print time.time() - start
+"""
+
+ALBUMS_CODE = """import time
+from create_albumdata import AlbumData, peak_memory
+album_data = AlbumData(%(path)r)
+album_data._resolve_scope()
+album_data._fetch_album_photos()
+library = album_data.library
+# queries aren't measured
+album_photo_ids = library.fetch_album_photo_ids()
+library.fetch_album_photo_ids = lambda **kwargs: album_photo_ids
+memory = peak_memory()
+start = time.time()
+album_data._build_albums()
+print time.time() - start, peak_memory() - memory, len(album_data.album_photo_ids)
+"""
+
+# name, arguments and output which is removed before each run
+ENTRY_POINTS = [
+    ("create_albumdata", ["create_albumdata.py", "-p", "%(path)s", "--force", "--full", "--no-cache",
+                          "%(output)s/albumdata.xml"],
+     None),
+    ("create_thumbnails", ["create_thumbnails.py", "-p", "%(path)s", "--no-cache", "%(output)s/thumbnails"],
+     "%(output)s/thumbnails"),
+    ("photos_tool", ["photos_tool.py", "-p", "%(db_path)s", "--photos", "--tree", "--no-cache"], None),
+    ("plist_diff", ["plist_diff.py", "%(output)s/albumdata.xml", "%(output)s/albumdata.xml"], None),
+]
+
+# consumer which reads both formats of plist and prints time of parsing
+CONSUMER = ["python3", "-c", "import plistlib, sys, time\n"
+                             "start = time.time()\n"
+                             "plistlib.load(open(sys.argv[1], 'rb'))\n"
+                             "print(time.time() - start)"]
+
+SERVER_CLIENTS = 4
+SERVER_REQUESTS = 500
+SERVER_START_TIMEOUT = 30
+
+# album lookup may grow faster than library by this factor before it's reported as superlinear
+SCALING_TOLERANCE = 2.0
+
+
+def run_python(code):
+    return subprocess.check_output([sys.executable, "-c", code], cwd=HERE)
+
+
+def run_script(args):
+    """Run script and measure it
+
+    :return: wall time in seconds and peak memory in bytes
+    """
+    with open(os.devnull, "w") as devnull:
+        start = time.time()
+        process = subprocess.Popen([sys.executable] + args, cwd=HERE, stdout=devnull, stderr=devnull)
+        _, status, usage = os.wait4(process.pid, 0)
+        elapsed = time.time() - start
+    process.returncode = os.WEXITSTATUS(status)
+    if process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, args)
+    memory = usage.ru_maxrss if sys.platform == "darwin" else usage.ru_maxrss * 1024
+    return elapsed, memory
+
+
+def _stats(times):
+    times = sorted(times)
+    return {"min": times[0], "median": times[len(times) // 2], "max": times[-1]}
+
+
+def startup(path, output, repeat):
+    """Time of import and construction of main object of each entry point"""
+    params = {"path": path, "db_path": os.path.join(path, "database"), "output": output}
+    results = dict()
+    for name, code in STARTUP:
+        logger.info("Startup of %s", name)
+        times = [float(run_python(STARTUP_CODE % (code % params))) for _ in range(repeat)]
+        results[name] = _stats(times)
+    return results
+
+
+def photos(path, repeat):
+    """Time and memory of photos which are kept as dict of objects and as table"""
+    results = dict()
+    for name, fetch in PHOTOS:
+        logger.info("Photos as %s", name)
+        runs = [run_python(PHOTOS_CODE % {"db_path": os.path.join(path, "database"), "fetch": fetch}).split()
+                for _ in range(repeat)]
+        results[name] = {
+            "time": _stats([float(t) for t, _ in runs]),
+            "memory": max(int(m) for _, m in runs),
+        }
+    return results
+
+
+def album_lookup(path, repeat):
+    """Time of fetching of photo ids of all albums"""
+    logger.info("Album lookup")
+    code = ALBUM_LOOKUP_CODE % {"db_path": os.path.join(path, "database")}
+    return _stats([float(run_python(code)) for _ in range(repeat)])
+
+
+def albums(path, repeat):
+    """Time and memory of building of albums and folders of albumdata"""
+    logger.info("Albums")
+    runs = [run_python(ALBUMS_CODE % {"path": path}).split() for _ in range(repeat)]
+    return {
+        "albums": int(runs[0][2]),
+        "time": _stats([float(t) for t, _, _ in runs]),
+        "memory": max(int(m) for _, m, _ in runs),
+    }
+
+
+def entry_points(path, output, repeat):
+    """Wall time and peak memory of each entry point"""
+    params = {"path": path, "db_path": os.path.join(path, "database"), "output": output}
+    results = dict()
+    for name, args, clean in ENTRY_POINTS:
+        logger.info("Run %s", name)
+        runs = []
+        for _ in range(repeat):
+            if clean and os.path.exists(clean % params):
+                shutil.rmtree(clean % params)
+            runs.append(run_script([a % params for a in args]))
+        results[name] = {
+            "time": _stats([t for t, _ in runs]),
+            "memory": max(m for _, m in runs),
+        }
+    return results
+
+
+def formats(path, output, repeat):
+    """Write time, size and parse time of albumdata in each format"""
+    consumer = distutils.spawn.find_executable(CONSUMER[0])
+    results = dict()
+    for output_format in ("xml", "binary"):
+        logger.info("Write %s albumdata", output_format)
+        plist_path = os.path.join(output, "albumdata." + output_format)
+        args = ["create_albumdata.py", "-p", path, "--force", "--full", "--no-cache", "--format", output_format,
+                plist_path]
+        runs = [run_script(args) for _ in range(repeat)]
+        result = results[output_format] = {
+            "time": _stats([t for t, _ in runs]),
+            "memory": max(m for _, m in runs),
+            "size": os.path.getsize(plist_path),
+            "parse": None,
+        }
+        if consumer:
+            times = [float(subprocess.check_output([consumer] + CONSUMER[1:] + [plist_path])) for _ in range(repeat)]
+            result["parse"] = _stats(times)
+    return results
+
+
+def _free_port():
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def _get(conn, url, headers=None):
+    conn.request("GET", url, headers=headers or {})
+    response = conn.getresponse()
+    body = response.read()
+    if response.status not in (200, 304):
+        raise RuntimeError("%s: %s %s" % (url, response.status, response.reason))
+    return response, body
+
+
+def _wait_server(port, process):
+    start = time.time()
+    while time.time() - start < SERVER_START_TIMEOUT:
+        if process.poll() is not None:
+            raise RuntimeError("Server exited with code %s" % process.returncode)
+        try:
+            socket.create_connection(("127.0.0.1", port)).close()
+            return
+        except socket.error:
+            time.sleep(0.1)
+    raise RuntimeError("Server isn't started in %s s" % SERVER_START_TIMEOUT)
+
+
+def _load(port, urls, etags, clients, requests):
+    """Send requests by keep-alive connections of parallel clients
+
+    :param etags: dict of ETag by url to send as If-None-Match or None
+    :return: requests per second and list of latencies
+    """
+    latencies = []
+    errors = []
+
+    def client(offset):
+        conn = httplib.HTTPConnection("127.0.0.1", port)
+        try:
+            for i in range(requests // clients):
+                url = urls[(offset + i) % len(urls)]
+                start = time.time()
+                _get(conn, url, {"If-None-Match": etags[url]} if etags else None)
+                latencies.append(time.time() - start)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            conn.close()
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(clients)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+    if errors:
+        raise errors[0]
+    return len(latencies) / elapsed, latencies
+
+
+def _latencies(latencies):
+    latencies = sorted(latencies)
+    return {
+        "p50": latencies[len(latencies) // 2],
+        "p99": latencies[min(len(latencies) - 1, len(latencies) * 99 // 100)],
+    }
+
+
+def server(path, requests, clients):
+    """Requests per second and latency of photo server with and without If-None-Match"""
+    port = _free_port()
+    logger.info("Start server on port %s", port)
+    with open(os.devnull, "w") as devnull:
+        process = subprocess.Popen([sys.executable, "photo_server.py", "-p", path, "--no-cache", "--port", str(port),
+                                    "--connections", str(clients)], cwd=HERE, stdout=devnull, stderr=devnull)
+    try:
+        _wait_server(port, process)
+        conn = httplib.HTTPConnection("127.0.0.1", port)
+        tree = json.loads(_get(conn, "/tree")[1])
+        folders = [tree]
+        albums = []
+        while folders:
+            folder = folders.pop()
+            folders += folder["folders"]
+            albums += folder["albums"]
+        photos = json.loads(_get(conn, "/photos?limit=1")[1])
+        urls = ["/photos?limit=100", "/tree"]
+        if albums:
+            urls.append("/albums/%s" % albums[0]["uuid"])
+        if photos and photos[0]["thumbnails"].get("mini"):
+            urls.append("/" + photos[0]["thumbnails"]["mini"])
+        etags = dict((url, _get(conn, url)[0].getheader("ETag")) for url in urls)
+        conn.close()
+
+        results = {"urls": urls}
+        for name, request_etags in (("full", None), ("not_modified", etags)):
+            logger.info("Load server by %s requests (%s)", requests, name)
+            rate, latencies = _load(port, urls, request_etags, clients, requests)
+            results[name] = dict(_latencies(latencies), requests_per_second=rate)
+        return results
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def check_scaling(results):
+    """Check that album lookup grows not faster than library
+
+    :return: list of errors
+    """
+    errors = []
+    scales = sorted((int(size), r["album_lookup"]["min"]) for size, r in results.items())
+    for (size, lookup), (next_size, next_lookup) in zip(scales, scales[1:]):
+        growth = next_lookup / max(lookup, 1e-6)
+        if growth > SCALING_TOLERANCE * next_size / size:
+            errors.append("Album lookup grows %.1f times from %s to %s photos" % (growth, size, next_size))
+    return errors
+
+
+def create_library(path, size, depth=DEPTH, fanout=FANOUT):
+    if os.path.exists(os.path.join(path, "database")):
+        return
+    logger.info("Create library of %s photos in %s", size, path)
+    SyntheticLibrary(path, photos=size, depth=depth, fanout=fanout, album_size=max(50, size // 100),
+                     file_size=256).create()
+
+
+def main():
+    parser = ArgumentParser(description=DESCR)
+    parser.add_argument("--path", "-p", help="Path to photos directory")
+    parser.add_argument("--scale", type=int, action="append",
+                        help="Benchmark synthetic library of given number of photos instead of path "
+                             "(can be repeated, e.g. 1000, 10000, 100000)")
+    parser.add_argument("--libraries", help="Directory to keep synthetic libraries between runs")
+    parser.add_argument("--depth", type=int, default=DEPTH,
+                        help="Depth of folder tree of synthetic libraries (6 gives 2k albums)")
+    parser.add_argument("--fanout", type=int, default=FANOUT, help="Subfolders in each folder of synthetic libraries")
+    parser.add_argument("--output", "-o", help="Directory for output of entry points (default is temp directory)")
+    parser.add_argument("--repeat", type=int, default=5, help="Number of runs of each benchmark")
+    parser.add_argument("--json", help="Write results to file instead of stdout")
+
+    bench_gr = parser.add_argument_group("Benchmarks")
+    bench_gr.add_argument("--startup", action="store_true", help="Import and construct time of entry points")
+    bench_gr.add_argument("--photos", action="store_true", help="Photos as dict of objects and as table")
+    bench_gr.add_argument("--album-lookup", action="store_true",
+                          help="Time of album lookup, fail if it grows superlinear between scales")
+    bench_gr.add_argument("--albums", action="store_true",
+                          help="Time and memory of building of albums and folders of albumdata")
+    bench_gr.add_argument("--entry-points", action="store_true", help="Time and peak memory of entry points")
+    bench_gr.add_argument("--formats", action="store_true",
+                          help="Write time, size and parse time of xml and binary albumdata")
+    bench_gr.add_argument("--server", action="store_true",
+                          help="Requests per second and latency of photo server with and without ETag")
+    parser.add_argument("--server-requests", type=int, default=SERVER_REQUESTS,
+                        help="Number of requests to server in each run")
+    parser.add_argument("--server-clients", type=int, default=SERVER_CLIENTS,
+                        help="Number of parallel keep-alive connections to server")
+
+    parser.add_argument("--log-level",
+                        choices=['INFO', 'WARNING', 'DEBUG', 'ERROR', 'CRITICAL'],
+                        help="Logging level",
+                        default='INFO')
+    args = parser.parse_args()
+    logging.basicConfig(format='%(message)s',
+                        level=getattr(logging, args.log_level))
+    if not args.path and not args.scale:
+        parser.error("path or scale is required")
+
+    output = os.path.abspath(args.output or tempfile.mkdtemp())
+    libraries_path = os.path.abspath(args.libraries or tempfile.mkdtemp())
+    if args.path:
+        libraries = [(args.path, os.path.abspath(args.path))]
+    else:
+        suffix = "" if (args.depth, args.fanout) == (DEPTH, FANOUT) else "_%dx%d" % (args.depth, args.fanout)
+        libraries = [(str(size), os.path.join(libraries_path, "photos_%d%s" % (size, suffix))) for size in args.scale]
+
+    results = dict()
+    errors = []
+    try:
+        for name, path in libraries:
+            if args.scale:
+                create_library(path, int(name), args.depth, args.fanout)
+            result = results[name] = dict()
+            if args.startup:
+                result["startup"] = startup(path, output, args.repeat)
+            if args.photos:
+                result["photos"] = photos(path, args.repeat)
+            if args.album_lookup:
+                result["album_lookup"] = album_lookup(path, args.repeat)
+            if args.albums:
+                result["albums"] = albums(path, args.repeat)
+            if args.entry_points:
+                result["entry_points"] = entry_points(path, output, args.repeat)
+            if args.formats:
+                result["formats"] = formats(path, output, args.repeat)
+            if args.server:
+                result["server"] = server(path, args.server_requests, args.server_clients)
+        if args.album_lookup and args.scale:
+            errors = check_scaling(results)
+    finally:
+        if not args.output:
+            shutil.rmtree(output)
+        if not args.libraries:
+            shutil.rmtree(libraries_path)
+
+    if args.json:
+        with open(args.json, "w") as json_file:
+            json.dump(results, json_file, indent=2, sort_keys=True)
+    else:
+        print json.dumps(results, indent=2, sort_keys=True)
+    for error in errors:
+        logger.error(error)
+    if errors:
+        exit(1)
+
+
+if __name__ == "__main__":
+    main()
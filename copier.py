@@ -0,0 +1,173 @@
+__author__ = 'namezys'
+
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+import os
+import shutil
+import sys
+import threading
+
+from multiprocessing.pool import ThreadPool
+
+from logging import getLogger
+
+logger = getLogger(__name__)
+
+COPY = "copy"
+HARD = "hard"
+REFLINK = "reflink"
+LINK_MODES = (COPY, HARD, REFLINK)
+SYMLINK = "symlink"
+DEDUP_MODES = (HARD, SYMLINK)
+
+FICLONE = 0x40049409
+
+# copies which can be scheduled for each thread before `copy` waits
+PENDING_PER_JOB = 64
+
+_clonefile = None
+if sys.platform == "darwin":
+    try:
+        _clonefile = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True).clonefile
+    except AttributeError:
+        pass
+
+
+def is_same(src_stat, dst_path):
+    """Destination has the same size and modification time as source"""
+    try:
+        dst_stat = os.stat(dst_path)
+    except OSError:
+        return False
+    return dst_stat.st_size == src_stat.st_size and int(dst_stat.st_mtime) == int(src_stat.st_mtime)
+
+
+def reflink(src, dst):
+    """Clone file using copy-on-write of file system
+
+    :raise EnvironmentError: if file system doesn't support it
+    """
+    if _clonefile is not None:
+        if _clonefile(src, dst, 0):
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        return
+    with open(src, "rb") as src_file:
+        with open(dst, "wb") as dst_file:
+            try:
+                fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+            except IOError:
+                dst_file.close()
+                os.unlink(dst)
+                raise
+
+
+def place_link(src, dst, mode):
+    """Make hard or relative symbolic link to file
+
+    :return: False if link is already in place
+    """
+    if mode == SYMLINK:
+        target = os.path.relpath(src, os.path.dirname(dst))
+        if os.path.islink(dst) and os.readlink(dst) == target:
+            return False
+    elif os.path.exists(dst) and os.path.samefile(src, dst):
+        return False
+    if os.path.lexists(dst):
+        os.unlink(dst)
+    if mode == SYMLINK:
+        os.symlink(target, dst)
+    else:
+        os.link(src, dst)
+    return True
+
+
+class Copier(object):
+    """Copy files by pool of threads
+
+    Files which have the same size and modification time as source are skipped.
+    Hard links and reflinks fall back to copy if they can't be created (e.g. across file systems).
+    Number of scheduled copies is bounded, so `copy` waits if threads are behind.
+
+    :ivar copied: number of copied files
+    :ivar linked: number of linked files
+    :ivar skipped: number of skipped files
+    """
+
+    def __init__(self, jobs=1, link=COPY, max_pending=None):
+        assert link in LINK_MODES
+        self.link = link
+        self.pool = ThreadPool(jobs)
+        self.slots = threading.BoundedSemaphore(max_pending or jobs * PENDING_PER_JOB)
+        self.pending = dict()
+        self.lock = threading.Lock()
+        self.copied = 0
+        self.linked = 0
+        self.skipped = 0
+
+    def copy(self, src, dst):
+        """Schedule copy of file
+
+        If destination is already scheduled, copy is started after previous one.
+        """
+        previous = self.pending.get(dst)
+        if previous is not None:
+            previous.get()
+        self.slots.acquire()
+        self.pending[dst] = self.pool.apply_async(self._copy, (src, dst))
+
+    def wait(self):
+        """Wait for all copies
+
+        :raise EnvironmentError: first error of copy
+        """
+        self.pool.close()
+        self.pool.join()
+        for result in self.pending.values():
+            result.get()
+        self.pending.clear()
+        logger.info("Copied %s, linked %s, skipped %s files", self.copied, self.linked, self.skipped)
+
+    def close(self):
+        """Stop threads, copies which aren't started yet are dropped"""
+        self.pool.terminate()
+        self.pool.join()
+
+    def _count(self, name):
+        with self.lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def _copy(self, src, dst):
+        try:
+            self._copy_file(src, dst)
+        finally:
+            self.slots.release()
+
+    def _copy_file(self, src, dst):
+        src_stat = os.stat(src)
+        if is_same(src_stat, dst):
+            logger.debug("Skip %s", dst)
+            self._count("skipped")
+            return
+        if os.path.lexists(dst):
+            os.unlink(dst)
+        if self.link != COPY:
+            try:
+                if self.link == HARD:
+                    os.link(src, dst)
+                else:
+                    reflink(src, dst)
+                    shutil.copystat(src, dst)
+                logger.debug("Link %s to %s", src, dst)
+                self._count("linked")
+                return
+            except EnvironmentError as e:
+                if e.errno not in (errno.EXDEV, errno.EPERM, errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL,
+                                   errno.EMLINK, errno.ENOTSUP):
+                    raise
+                logger.debug("Can't link %s to %s (%s), copy it", src, dst, e)
+        logger.debug("Copy %s to %s", src, dst)
+        shutil.copy2(src, dst)
+        self._count("copied")
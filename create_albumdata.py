@@ -1,5 +1,11 @@
+import collections
+import cPickle
+import hashlib
+import itertools
 import logging
 import plistlib
+import resource
+import sys
 
 import os
 import copy
@@ -7,8 +13,14 @@ import copy
 from argparse import ArgumentParser
 
 from library import Library
+from pipeline import Pipeline
 from album import Album
 from folder import Folder
+from membership import Membership
+from plist_writer import WRITERS, XML
+from profiler import Profiler, FORMATS, TABLE, phase
+from snapshot import DEFAULT_CACHE_DIR
+from watcher import watch, POLL_INTERVAL, DEBOUNCE
 
 logger = logging.getLogger(__name__)
 
@@ -24,7 +36,11 @@ BASE = {
 ARCHIVE_PATH = "Archive Path"
 ALBUMS = "List of Albums"
 IMAGES = "Master Image List"
-ALBUMS = "List of Albums"
+ROLLS = "List of Rolls"
+
+AlbumPhoto = collections.namedtuple("AlbumPhoto", ["id", "is_favorite", "image_date_ts"])
+
+STATE_VERSION = 1
 
 
 def _iphoto_id(obj):
@@ -34,18 +50,67 @@ def _iphoto_id(obj):
         return obj.id * 10000
 
 
+def peak_memory():
+    """Peak resident memory of process in bytes"""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+def _file_stamp(path):
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime
+
+
+def load_state(state_path):
+    """Load state of previous run or None if it's absent or unusable"""
+    if not os.path.exists(state_path):
+        return None
+    try:
+        with open(state_path, "rb") as state_file:
+            state = cPickle.load(state_file)
+    except (EnvironmentError, cPickle.UnpicklingError, EOFError) as e:
+        logger.warning("Can't read state %s: %s", state_path, e)
+        return None
+    if state.get("version") != STATE_VERSION:
+        return None
+    return state
+
+
+def save_state(state_path, state):
+    tmp_state_path = state_path + ".tmp"
+    with open(tmp_state_path, "wb") as state_file:
+        cPickle.dump(state, state_file, cPickle.HIGHEST_PROTOCOL)
+    os.rename(tmp_state_path, state_path)
+
+
 class AlbumData(object):
-    def __init__(self, path, disable_rolls=None, disable_rating=None, tmp_db=None, gen_caption=None):
+    def __init__(self, path, disable_rolls=None, disable_rating=None, tmp_db=None, gen_caption=None, profiler=None,
+                 output_format=XML, cache_dir=None, library=None, folder=None, album=None):
+        """
+        :param folder: uuid or path of folder to export only it
+        :param album: uuid of album to export only it
+        """
         self.path = os.path.abspath(path)
+        self.profiler = profiler
+        self.output_format = output_format
 
         db_path = os.path.join(path, "database")
-        self.library = Library(db_path, tmp_db)
+        self.library = library or Library(db_path, tmp_db, profiler=profiler, cache_dir=cache_dir)
 
         self.data = copy.deepcopy(BASE)
         self.data[ARCHIVE_PATH] = self.path
         self.data[ALBUMS] = []
 
+        self.folder = folder
+        self.album = album
+        self.root = None
+        self.album_ids = None
+
         self.photos = dict()
+        self.album_photo_ids = dict()
+        self.membership = None
+        self.favorite_keys = []
+        self.first_photo = None
 
         self.disable_rolls = disable_rolls
         self.disable_rating = disable_rating
@@ -54,71 +119,238 @@ class AlbumData(object):
         self.generate_caption = gen_caption
 
     def build(self):
+        self._resolve_scope()
         logger.debug("Fetch photos")
-        self.photos = dict((p.id, p) for p in self.library.fetch_photos())
+        with phase(self.profiler, "photos"):
+            self.photos = self.library.fetch_photo_table(self.album_ids)
+        self._build_albums()
 
+        logger.debug("Save images")
+        with phase(self.profiler, "images"):
+            self.data[IMAGES] = dict((str(p.id), self._photo(p)) for p in self.photos.values())
+
+    def update(self, xml_path, state_path, full=False):
+        """Write albumdata patching output of previous run
+
+        Only fields which are needed for albums are kept for each photo.
+        Images are fetched again in order of keys and written one by one, so they aren't kept in memory.
+        State keeps stamp of photos, digest of albums and position of every image in previous output.
+        Only photos which were modified since previous run are fetched, other images are copied from previous output.
+        Binary output isn't patched, it's only skipped if nothing is changed.
+
+        :param full: ignore state and write everything
+        :return: False if nothing is changed and albumdata isn't written
+        """
+        self._resolve_scope()
+        state = None if full else load_state(state_path)
+        options = [self.path, self.disable_rolls, self.disable_rating, self.generate_caption, self.output_format,
+                   self.folder, self.album]
+        if state and (state["options"] != options or not os.path.exists(xml_path) or
+                      state["xml"] != _file_stamp(xml_path)):
+            logger.info("Previous output is changed, write everything")
+            state = None
+
+        modified = self._fetch_album_photos()
+        photos_stamp = [modified, len(self.photos), sum(self.photos)]
+        self._build_albums()
+        albums_digest = hashlib.md5(plistlib.writePlistToString(self.data)).hexdigest()
+        if state and state["photos"] == photos_stamp and state["albums"] == albums_digest:
+            logger.info("Nothing is changed")
+            return False
+
+        tmp_xml_path = xml_path + ".tmp"
+        with open(tmp_xml_path, "wb") as xml_file:
+            if state and state["images"] is not None:
+                with open(xml_path) as previous_xml:
+                    offsets = self._write(xml_file, previous_xml, state["images"], state["modified"])
+            else:
+                offsets = self._write(xml_file)
+        os.rename(tmp_xml_path, xml_path)
+        save_state(state_path, {
+            "version": STATE_VERSION,
+            "options": options,
+            "xml": _file_stamp(xml_path),
+            "photos": photos_stamp,
+            "albums": albums_digest,
+            "modified": modified,
+            "images": offsets,
+        })
+        return True
+
+    def _resolve_scope(self):
+        """Find root folder and albums of exported part of library
+
+        :raise KeyError: if folder or album isn't found
+        """
+        with phase(self.profiler, "scope"):
+            self.root, self.album_ids = self.library.scope(self.folder, self.album)
+
+    def _fetch_album_photos(self):
+        """Fetch fields of photos which are needed for albums
+
+        :return: last modification date of photos
+        """
+        logger.debug("Fetch photos")
+        self.photos = dict()
+        modified = None
+        with phase(self.profiler, "photos"):
+            for photo_id, favorite, image_date_ts, modified_ts in self.library.fetch_photo_summary(self.album_ids):
+                self.photos[photo_id] = AlbumPhoto(photo_id, bool(favorite), image_date_ts)
+                modified = max(modified, modified_ts)
+        return modified
+
+    def _write(self, xml_file, previous_xml=None, previous_images=None, modified_since=None):
+        """Write albumdata
+
+        If previous output is given, images of photos which aren't modified since `modified_since`
+        are copied from it.
+
+        :return: dict of photo id to offset and length of image in xml output or None for binary one
+        """
+        logger.debug("Write albums and images")
+        writer = WRITERS[self.output_format](xml_file)
+        writer.begin_dict()
+        for key in sorted(self.data.keys() + [IMAGES]):
+            if key != IMAGES:
+                writer.write_item(key, self.data[key])
+                continue
+            writer.begin_dict(IMAGES)
+            with phase(self.profiler, "images"):
+                if previous_xml:
+                    offsets = self._write_changed_images(writer, xml_file, previous_xml, previous_images,
+                                                         modified_since)
+                else:
+                    photos = self.library.fetch_photos(key_order=True, album_ids=self.album_ids)
+                    offsets = self._write_images(writer, xml_file, photos)
+            writer.end_dict()
+        writer.end_dict()
+        writer.close()
+        return offsets if self.output_format == XML else None
+
+    def _write_images(self, writer, xml_file, photos):
+        """Fetch photos, make images and write them by stages of pipeline"""
+        offsets = dict()
+
+        def write(item):
+            photo_id, image = item
+            start = xml_file.tell()
+            writer.write_item(str(photo_id), image)
+            offsets[photo_id] = (start, xml_file.tell() - start)
+
+        pipeline = Pipeline(self.profiler)
+        pipeline.source("fetch", photos).transform("image", lambda p: (p.id, self._photo(p)))
+        pipeline.run("write", write)
+        return offsets
+
+    def _write_changed_images(self, writer, xml_file, previous_xml, previous_images, modified_since):
+        changed = dict((p.id, p) for p in self.library.fetch_photos(modified_since=modified_since,
+                                                                         album_ids=self.album_ids))
+        if any(i not in previous_images and i not in changed for i in self.photos):
+            logger.info("Some photos aren't in previous output, write all images")
+            photos = self.library.fetch_photos(key_order=True, album_ids=self.album_ids)
+            return self._write_images(writer, xml_file, photos)
+        logger.info("Write %s changed images", len(changed))
+        offsets = dict()
+        for key in sorted(str(i) for i in self.photos):
+            photo_id = int(key)
+            start = xml_file.tell()
+            if photo_id in changed:
+                writer.write_item(key, self._photo(changed[photo_id]))
+            else:
+                previous_start, length = previous_images[photo_id]
+                previous_xml.seek(previous_start)
+                xml_file.write(previous_xml.read(length))
+            offsets[photo_id] = (start, xml_file.tell() - start)
+        return offsets
+
+    def _build_albums(self):
         logger.debug("Save folders and albums")
-        self.data[ALBUMS] += [self._all_photos_album, self._flagged_album]
-        self.save_folder(self.library.top_folder, None)
+        with phase(self.profiler, "folders"):
+            self.album_photo_ids = self.library.fetch_album_photo_ids(album_ids=self.album_ids)
+            self._index_photos()
+            self.data[ALBUMS] += [self._all_photos_album, self._flagged_album]
+            self.save_folder(self.root, None)
 
         logger.debug("Save rolls")
-        if not self.disable_rolls:
-            self.data["List of Rolls"] = [self._all_roll]
-
-        logger.debug("Save images")
-        self.data[IMAGES] = dict((str(p.id), self._photo(p)) for p in self.photos.values())
+        with phase(self.profiler, "rolls"):
+            if not self.disable_rolls:
+                self.data[ROLLS] = [self._all_roll]
+
+    def _index_photos(self):
+        """Make keys of photos once and collect favorites and first photo by one pass over photos"""
+        self.membership = Membership(itertools.chain(self.photos, *self.album_photo_ids.values()))
+        self.favorite_keys = []
+        first_photo = None
+        for photo in self.photos.itervalues():
+            if photo.is_favorite:
+                self.favorite_keys.append(self.membership.key(photo.id))
+            if first_photo is None:
+                first_photo = [photo.image_date_ts, photo.id]
+            else:
+                first_photo[0] = min(first_photo[0], photo.image_date_ts)
+                first_photo[1] = min(first_photo[1], photo.id)
+        self.first_photo = first_photo
 
     def save_folder(self, folder, parent):
+        """Save folder with all its subfolders and albums
+
+        :return: photos of folder as set of `Membership`
+        """
         logger.debug("Save %s with parent %s", folder, parent)
-        photo_ids = set()
-        if folder != self.library.top_folder:
+        if folder != self.root:
             data = self._album_base(folder, [], parent=parent)
             self.data[ALBUMS].append(data)
-        parent = (folder if folder != self.library.top_folder else None)
-        for sub_folder in self.library.fetch_subfolders(folder):
-            photo_ids |= self.save_folder(sub_folder, parent)
-        for album in self.library.fetch_albums(folder):
-            photo_ids |= self.save_album(album, parent)
-        if folder != self.library.top_folder:
-            self._append_photos(data, photo_ids)
-        logger.debug("Got %s photos for %s", len(photo_ids), folder)
-        return photo_ids
+        parent = (folder if folder != self.root else None)
+        photo_sets = [self.save_folder(sub_folder, parent) for sub_folder in folder.folders]
+        photo_sets += [self.save_album(album, parent) for album in folder.albums]
+        photo_set = self.membership.union(photo_sets)
+        if folder != self.root:
+            self._append_photos(data, self.membership.keys(photo_set))
+            logger.debug("Got %s photos for %s", data["PhotoCount"], folder)
+        return photo_set
 
     def save_album(self, album, parent):
+        """Save album
+
+        :return: sorted photo ids of album
+        """
         logger.debug("Save %s with parent %s", album, parent)
-        photo_ids = set(self.library.fetch_album_photo_id_list(album))
-        self.data[ALBUMS].append(self._album_base(album, photo_ids, parent=parent))
+        photo_ids = self.album_photo_ids.get(album.id, ())
+        self.data[ALBUMS].append(self._album_base(album, self.membership.keys(photo_ids), parent=parent))
         return photo_ids
 
     def walk_through_tree(self, folder):
         logger.info("Process %s", folder)
-        for album in self.library.fetch_albums(folder):
+        for album in folder.albums:
             logger.info("Write %s", album)
 
-        for folder in self.library.fetch_subfolders(folder):
+        for folder in folder.folders:
             self.walk_through_tree(folder)
 
     @property
     def _all_photos_album(self):
         album = self.library.all_photos_album
-        photo_ids = self.photos.keys()
-        data = self._album_base(album, photo_ids, album_type="99", name="Photos")
+        keys = self.membership.keys(sorted(self.photos))
+        data = self._album_base(album, keys, album_type="99", name="Photos")
         data["Master"] = True
         return data
 
     @property
     def _flagged_album(self):
         album = self.library.favorites
-        photo_ids = list(str(p.id) for p in self.photos.values() if p.is_favorite)
-        return self._album_base(album, photo_ids, album_type="Flagged", name="Flagged", sort_order="1")
+        keys = sorted(self.favorite_keys)
+        return self._album_base(album, keys, album_type="Flagged", name="Flagged", sort_order="1")
 
     @property
     def _last_imported_album(self):
         album = self.library.last_import_album
-        photo_ids = set(self.library.fetch_album_photo_id_list(album))
-        return self._album_base(album, photo_ids)
+        keys = self.membership.keys(self.album_photo_ids.get(album.id, ()))
+        return self._album_base(album, keys)
 
-    def _album_base(self, album, photo_ids, name=None, album_type=None, sort_order=None, parent=None):
+    def _album_base(self, album, keys, name=None, album_type=None, sort_order=None, parent=None):
+        """
+        :param keys: sorted keys of photos
+        """
         if album_type is None:
             if isinstance(album, Album):
                 album_type = "Regular"
@@ -136,13 +368,13 @@ class AlbumData(object):
             data["Sort Order"] = sort_order
         if parent:
             data["Parent"] = _iphoto_id(parent)
-        if photo_ids:
-            self._append_photos(data, photo_ids)
+        if keys:
+            self._append_photos(data, keys)
         return data
 
-    def _append_photos(self, data, photo_ids):
-        data["KeyList"] = list(str(k) for k in sorted(photo_ids))
-        data["PhotoCount"] = len(photo_ids)
+    def _append_photos(self, data, keys):
+        data["KeyList"] = keys
+        data["PhotoCount"] = len(keys)
         return data
 
     def _photo(self, photo):
@@ -171,16 +403,21 @@ class AlbumData(object):
 
     @property
     def _all_roll(self):
-        """One fake event"""
-        return {
+        """One fake event
+
+        Event of empty scope (e.g. album without photos) has no key photo and date.
+        """
+        roll = {
             "RollID": self.all_roll_id,
             "ProjectUuid": "RBoLkXF0QxGHAqJTrs9p0Q",
             "RollName": "Photos",
-            "RollDateAsTimerInterval": min(p.image_date_ts for p in self.photos.values()),
-            "KeyPhotoKey": str(min(p.id for p in self.photos.values())),
             "PhotoCount": len(self.photos),
-            "KeyList": list(str(p.id) for p in self.photos.values())
+            "KeyList": self.membership.keys(self.photos)
         }
+        if self.first_photo is not None:
+            roll["RollDateAsTimerInterval"] = self.first_photo[0]
+            roll["KeyPhotoKey"] = self.membership.key(self.first_photo[1])
+        return roll
 
 
 def main():
@@ -190,26 +427,64 @@ def main():
     parser.add_argument("--disable-rating", action="store_true", help="Disable 5-stars iPhoto rating for favorite")
     parser.add_argument("--generate-caption", action="store_true", help="Generate caption like photo_id")
     parser.add_argument("--tmp-db", action="store_true", help="Create temp copy of db if it is locked")
+    parser.add_argument("--cache-dir", default=DEFAULT_CACHE_DIR, help="Directory to keep snapshot of library")
+    parser.add_argument("--no-cache", action="store_true", help="Read databases without snapshot of library")
 
     parser.add_argument("--log-level",
                         choices=['INFO', 'WARNING', 'DEBUG', 'ERROR', 'CRITICAL'],
                         help="Logging level",
                         default='INFO')
-    parser.add_argument("--force", action="store_true", help="Rewrite xml if it's exist")
+    parser.add_argument("--force", action="store_true", help="Rewrite xml if it's exist and it isn't written by "
+                                                             "previous run with state")
+    parser.add_argument("--full", action="store_true", help="Ignore state of previous run and write everything")
+    parser.add_argument("--state", help="Path to state of previous run (default is xml path with .state)")
+    parser.add_argument("--profile", nargs="?", const=TABLE, choices=FORMATS,
+                        help="Print statistics of queries and phases at exit")
+    parser.add_argument("--explain", action="store_true", help="Capture query plans for profile")
+    parser.add_argument("--format", choices=sorted(WRITERS), default=XML, help="Format of plist")
+    parser.add_argument("--watch", action="store_true", help="Keep running and rebuild on change of database")
+    parser.add_argument("--poll-interval", type=float, default=POLL_INTERVAL,
+                        help="Seconds between checks of database if inotify isn't available")
+    parser.add_argument("--debounce", type=float, default=DEBOUNCE,
+                        help="Seconds without changes of database before rebuild")
+    parser.add_argument("--status", help="Path to write json with statistics of rebuilds in watch mode")
+    scope_gr = parser.add_mutually_exclusive_group()
+    scope_gr.add_argument("--folder", help="Export only folder with given uuid or path like 'Folder/Subfolder'")
+    scope_gr.add_argument("--album", help="Export only album with given uuid")
     parser.add_argument("xml_path", help="Path to write xml")
 
     args = parser.parse_args()
     logging.basicConfig(format='%(message)s',
                         level=getattr(logging, args.log_level))
 
-    album_data = AlbumData(args.path, disable_rolls=args.disable_rolls, disable_rating=args.disable_rating,
-                           tmp_db=args.tmp_db, gen_caption=args.generate_caption)
-    album_data.build()
-
-    if not args.force and os.path.exists(args.xml_path):
+    state_path = args.state or args.xml_path + ".state"
+    # xml of previous run is updated, stamp of it is checked by update
+    if not args.force and os.path.exists(args.xml_path) and not os.path.exists(state_path):
         print "File", args.xml_path, "exists"
         exit(1)
-    plistlib.writePlist(album_data.data, args.xml_path)
+
+    profiler = Profiler(explain=args.explain) if args.profile else None
+    library = Library(os.path.join(args.path, "database"), args.tmp_db, profiler=profiler,
+                      cache_dir=None if args.no_cache else args.cache_dir)
+    if args.folder or args.album:
+        try:
+            library.scope(args.folder, args.album)
+        except KeyError as e:
+            parser.error("%s isn't found" % e)
+
+    def build():
+        album_data = AlbumData(args.path, disable_rolls=args.disable_rolls, disable_rating=args.disable_rating,
+                               gen_caption=args.generate_caption, profiler=profiler, output_format=args.format,
+                               library=library, folder=args.folder, album=args.album)
+        album_data.update(args.xml_path, state_path, full=args.full)
+
+    if args.watch:
+        watch(library, build, args.poll_interval, args.debounce, args.status)
+    else:
+        build()
+    logger.info("Peak memory %.1f MB", peak_memory() / 1048576.0)
+    if profiler:
+        profiler.dump(args.profile)
 
 
 if __name__ == "__main__":
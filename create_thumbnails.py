@@ -1,13 +1,21 @@
 import logging
 import plistlib
-import shutil
 
 import os
 import copy
+import shutil
+import tempfile
 
 from argparse import ArgumentParser
 
+from archive import FORMATS as ARCHIVE_FORMATS, STDOUT, open_archive
+from copier import Copier, LINK_MODES, COPY, DEDUP_MODES, place_link
 from library import Library
+from pipeline import Pipeline
+from resizer import Resizer, DEFAULT_QUALITY, JPEG_EXT, NO_PIL, Image
+from watcher import watch, POLL_INTERVAL, DEBOUNCE
+from profiler import Profiler, FORMATS, TABLE, phase
+from snapshot import DEFAULT_CACHE_DIR
 from album import Album
 from folder import Folder
 
@@ -27,6 +35,10 @@ ALBUMS = "List of Albums"
 IMAGES = "Master Image List"
 ALBUMS = "List of Albums"
 
+HD_SIZE = 1024
+
+STORE = ".store"
+
 
 def _iphoto_id(obj):
     if isinstance(obj, Album):
@@ -36,70 +48,284 @@ def _iphoto_id(obj):
 
 
 class SaveThumbnails(object):
-    def __init__(self, path, photos_path, tmp_db):
+    def __init__(self, path, photos_path, tmp_db, jobs=1, link=COPY, sort_in_db=False, profiler=None,
+                 cache_dir=None, max_size=None, quality=DEFAULT_QUALITY, resize_cache_dir=None, dedup=None,
+                 library=None, folder=None, album=None, archive=None):
+        """
+        :param max_size: write JPEG which fits in square of this size instead of copy of thumbnail
+        :param quality: quality of resized JPEG
+        :param resize_cache_dir: directory to keep resized images
+        :param dedup: copy each photo once to store and make hard or symbolic links to it in albums
+        :param folder: uuid or path of folder to save only it
+        :param album: uuid of album to save only it
+        :param archive: `archive.Archive` to write album directories and photos instead of directory `path`
+        """
         self.path = os.path.abspath(path)
         self.photos_path = photos_path
+        self.sort_in_db = sort_in_db
+        self.dedup = dedup
+        self.stored = set()
+        self.store_links = []
+        self.copier = Copier(jobs, link)
+        self.resizer = Resizer(max_size, resize_cache_dir, quality) if max_size else None
+        self.profiler = profiler
+        self.archive = archive
+        self.archived_dirs = set()
 
         db_path = os.path.join(photos_path, "database")
-        self.library = Library(db_path, tmp_db)
+        self.library = library or Library(db_path, tmp_db, profiler=profiler, cache_dir=cache_dir)
+
+        self.folder = folder
+        self.album = album
+        self.root = None
 
         self.photos = dict()
+        self.album_photo_ids = dict()
 
     def build(self):
+        with phase(self.profiler, "scope"):
+            self.root, album_ids = self.library.scope(self.folder, self.album)
+
         logger.debug("Fetch photos")
-        self.photos = dict((p.id, p) for p in self.library.fetch_photos())
+        with phase(self.profiler, "photos"):
+            self.photos = self.library.fetch_photo_table(album_ids)
 
         logger.debug("Save folders and albums")
-        self.save_folder(self.library.top_folder, None)
+        with phase(self.profiler, "folders"):
+            self.album_photo_ids = self.library.fetch_album_photo_ids(date_order=self.sort_in_db, album_ids=album_ids)
+        with phase(self.profiler, "copy"):
+            pipeline = Pipeline(self.profiler)
+            pipeline.source("albums", self.walk_folder(self.root, None))
+            pipeline.transform("files", self.album_files)
+            if self.resizer:
+                pipeline.transform("resize", self.resize_files)
+            try:
+                if self.archive:
+                    pipeline.run("archive", self.archive_files)
+                else:
+                    pipeline.run("copy", self.copy_files)
+                    self.copier.wait()
+            finally:
+                # threads and processes are stopped even if build fails, e.g. in watch mode
+                self.copier.close()
+                if self.resizer:
+                    self.resizer.close()
+        if self.dedup:
+            with phase(self.profiler, "link"):
+                self.link_files()
+
+    def walk_folder(self, folder, parent_path):
+        """Create directories of folder and its albums
 
-    def save_folder(self, folder, parent_path):
+        Directories aren't created if archive is written, they are added to archive with photos of albums.
+
+        :return: iterator of albums with their paths
+        """
         logger.debug("Save %s with parent %s", folder, parent_path)
-        path = os.path.join(parent_path, folder.name) if folder != self.library.top_folder else "."
-        logger.debug("Create directory %s", path)
-        if not os.path.exists(os.path.join(self.path, path)):
-            os.makedirs(os.path.join(self.path, path))
-        for sub_folder in self.library.fetch_subfolders(folder):
-            self.save_folder(sub_folder, path)
-        for album in self.library.fetch_albums(folder):
-            self.save_album(album, path)
-
-    def save_album(self, album, parent_path):
-        logger.debug("Save %s with parent %s", album, parent_path)
-        path = os.path.join(parent_path, album.name)
+        path = os.path.join(parent_path, folder.name) if folder != self.root else "."
+        self.make_dir(path)
+        if self.dedup and folder == self.root:
+            self.make_dir(STORE)
+        for sub_folder in folder.folders:
+            for item in self.walk_folder(sub_folder, path):
+                yield item
+        for album in folder.albums:
+            album_path = os.path.join(path, album.name)
+            self.make_dir(album_path)
+            yield album, album_path
+
+    def make_dir(self, path):
+        if self.archive:
+            return
         logger.debug("Create directory %s", path)
         if not os.path.exists(os.path.join(self.path, path)):
             os.makedirs(os.path.join(self.path, path))
-        photos = set(self.photos[i] for i in self.library.fetch_album_photo_id_list(album))
-        for photo in sorted(photos, key=lambda  p: p.date):
-            self.save_photo(photo, path)
 
-    def save_photo(self, photo, parent_path):
+    def album_files(self, item):
+        """Get sources and destinations of photos of album
+
+        :return: path of album and list of source, destination and uuid of each photo
+        """
+        album, path = item
+        logger.debug("Save %s to %s", album, path)
+        photos = [self.photos[i] for i in self.album_photo_ids.get(album.id, ())]
+        if not self.sort_in_db:
+            photos.sort(key=lambda p: p.sort_key)
+        return path, [self.photo_file(photo, path) for photo in photos]
+
+    def photo_file(self, photo, parent_path):
         caption = photo.name or "Photo_%d" % photo.id
-        file_name = photo.thumbnails["hd"] or photo.thumbnails["mini"] or photo.original
-        src = os.path.join(self.photos_path, file_name)
-        ext = os.path.splitext(src)[1]
+        src = self.photo_source(photo)
+        ext = JPEG_EXT if self.resizer else os.path.splitext(src)[1]
         dst = os.path.join(self.path, parent_path, caption + ext)
-        logger.debug("Copy %s to %s", src, dst)
-        shutil.copy(src, dst)
+        return src, dst, photo.uuid
+
+    def photo_source(self, photo):
+        """First existing file of photo
+
+        HD thumbnail is preferred, original is preferred if it's resized to size which is larger than HD one.
+        """
+        file_names = [photo.thumbnails["hd"], photo.thumbnails["mini"], photo.original]
+        if self.resizer:
+            if self.resizer.max_size > HD_SIZE:
+                file_names = [photo.original, photo.thumbnails["hd"]]
+            else:
+                file_names = [photo.thumbnails["hd"], photo.original]
+        for file_name in file_names:
+            src = os.path.join(self.photos_path, file_name)
+            if os.path.exists(src):
+                return src
+        return os.path.join(self.photos_path, file_names[0])
+
+    def resize_files(self, item):
+        """Replace sources by resized images
+
+        Source which isn't resized is copied as is with its own extension.
+        """
+        album_path, files = item
+        resized = self.resizer.resize([src for src, _, _ in files])
+        result = []
+        for path, (src, dst, uuid) in zip(resized, files):
+            if path == src:
+                dst = os.path.splitext(dst)[0] + os.path.splitext(src)[1]
+            result.append((path, dst, uuid))
+        return album_path, result
+
+    def archive_files(self, item):
+        """Add directory of album with its parents and photos of album to archive"""
+        album_path, files = item
+        album_path = os.path.normpath(album_path)
+        parents = []
+        while album_path not in self.archived_dirs and album_path != os.curdir:
+            parents.append(album_path)
+            album_path = os.path.dirname(album_path) or os.curdir
+        for path in reversed(parents):
+            self.archive.add_dir(path)
+            self.archived_dirs.add(path)
+        for src, dst, _ in files:
+            self.archive.add_file(src, os.path.relpath(dst, self.path))
+
+    def copy_files(self, item):
+        _, files = item
+        for src, dst, uuid in files:
+            if not self.dedup:
+                self.copier.copy(src, dst)
+                continue
+            store_path = os.path.join(self.path, STORE, uuid + os.path.splitext(dst)[1])
+            if store_path not in self.stored:
+                self.stored.add(store_path)
+                self.copier.copy(src, store_path)
+            self.store_links.append((store_path, dst))
+
+    def link_files(self):
+        """Link photos of albums to store after all photos are copied to it"""
+        linked = 0
+        saved = 0
+        for store_path, dst in self.store_links:
+            if place_link(store_path, dst, self.dedup):
+                linked += 1
+            saved += os.path.getsize(store_path)
+        saved -= sum(os.path.getsize(p) for p in self.stored)
+        logger.info("Linked %s of %s files to %s stored ones, avoided %s copies and %.1f MB",
+                    linked, len(self.store_links), len(self.stored), len(self.store_links) - len(self.stored),
+                    saved / 1048576.0)
 
 
 def main():
     parser = ArgumentParser(description=DESCR)
     parser.add_argument("--path", "-p", required=True, help="Path to photos directory", default=".")
     parser.add_argument("--tmp-db", action="store_true", help="Create temp copy of db if it is locked")
+    parser.add_argument("--cache-dir", default=DEFAULT_CACHE_DIR,
+                        help="Directory to keep snapshot of library and resized images "
+                             "(resized images aren't removed, old ones can be deleted with its 'resized' subdirectory)")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="Read databases without snapshot of library and keep resized images in temp directory")
+    parser.add_argument("--jobs", "-j", type=int, default=4, help="Number of parallel copies")
+    parser.add_argument("--link", choices=LINK_MODES, default=COPY,
+                        help="Create hard links or reflinks instead of copies if it's possible")
+    parser.add_argument("--sort-in-db", action="store_true", help="Sort photos of albums by date in database")
+    parser.add_argument("--max-size", type=int, help="Write JPEG which fits in square of this size (requires PIL)")
+    parser.add_argument("--quality", type=int, default=DEFAULT_QUALITY, help="Quality of resized JPEG")
+    parser.add_argument("--dedup", choices=DEDUP_MODES,
+                        help="Copy each photo once to %s and link it to albums by hard or symbolic links" % STORE)
+    parser.add_argument("--watch", action="store_true", help="Keep running and rebuild on change of database")
+    parser.add_argument("--poll-interval", type=float, default=POLL_INTERVAL,
+                        help="Seconds between checks of database if inotify isn't available")
+    parser.add_argument("--debounce", type=float, default=DEBOUNCE,
+                        help="Seconds without changes of database before rebuild")
+    parser.add_argument("--status", help="Path to write json with statistics of rebuilds in watch mode")
+    scope_gr = parser.add_mutually_exclusive_group()
+    scope_gr.add_argument("--folder", help="Save only folder with given uuid or path like 'Folder/Subfolder'")
+    scope_gr.add_argument("--album", help="Save only album with given uuid")
+    parser.add_argument("--archive", metavar="PATH",
+                        help="Write albums to tar or zip archive (by extension) or to stdout by '%s' "
+                             "instead of directory" % STDOUT)
+    parser.add_argument("--archive-format", choices=ARCHIVE_FORMATS,
+                        help="Format of archive (default is guessed by extension, tar for stdout)")
 
     parser.add_argument("--log-level",
                         choices=['INFO', 'WARNING', 'DEBUG', 'ERROR', 'CRITICAL'],
                         help="Logging level",
                         default='INFO')
-    parser.add_argument("directory", help="Path to write thumbnails")
+    parser.add_argument("--profile", nargs="?", const=TABLE, choices=FORMATS,
+                        help="Print statistics of queries and phases at exit")
+    parser.add_argument("--explain", action="store_true", help="Capture query plans for profile")
+    parser.add_argument("directory", nargs="?", help="Path to write thumbnails")
 
     args = parser.parse_args()
     logging.basicConfig(format='%(message)s',
                         level=getattr(logging, args.log_level))
 
-    album_data = SaveThumbnails(args.directory, args.path, tmp_db=args.tmp_db)
-    album_data.build()
+    if args.max_size and Image is None:
+        parser.error(NO_PIL)
+    if bool(args.directory) == bool(args.archive):
+        parser.error("Either directory or archive is required")
+    if args.archive and args.dedup:
+        parser.error("Deduplication isn't supported for archive")
+    if args.archive == STDOUT and args.watch:
+        parser.error("Archive can't be written to stdout in watch mode")
+
+    profiler = Profiler(explain=args.explain) if args.profile else None
+    library = Library(os.path.join(args.path, "database"), args.tmp_db, profiler=profiler,
+                      cache_dir=None if args.no_cache else args.cache_dir)
+    if args.folder or args.album:
+        try:
+            library.scope(args.folder, args.album)
+        except KeyError as e:
+            parser.error("%s isn't found" % e)
+
+    resize_cache_dir = os.path.join(args.cache_dir, "resized")
+    tmp_resize_dir = None
+    if args.max_size and args.no_cache:
+        resize_cache_dir = tmp_resize_dir = tempfile.mkdtemp(prefix="resized")
+
+    def build():
+        archive = open_archive(args.archive, args.archive_format) if args.archive else None
+        try:
+            album_data = SaveThumbnails(args.directory or ".", args.path, tmp_db=args.tmp_db, jobs=args.jobs,
+                                        link=args.link, sort_in_db=args.sort_in_db, profiler=profiler,
+                                        max_size=args.max_size, quality=args.quality,
+                                        resize_cache_dir=resize_cache_dir, dedup=args.dedup,
+                                        library=library, folder=args.folder, album=args.album, archive=archive)
+            album_data.build()
+        except BaseException:
+            if archive:
+                archive.abort()
+            raise
+        if archive:
+            archive.close()
+            logger.info("Archived %s files, %.1f MB", archive.files, archive.size / 1048576.0)
+
+    try:
+        if args.watch:
+            watch(library, build, args.poll_interval, args.debounce, args.status)
+        else:
+            build()
+    finally:
+        if tmp_resize_dir:
+            shutil.rmtree(tmp_resize_dir, ignore_errors=True)
+    if profiler:
+        profiler.dump(args.profile)
 
 
 if __name__ == "__main__":
@@ -6,8 +6,8 @@ class Folder(object):
 
     :ivar uuid:
     :ivar name:
-    :ivar folders: set of subfolders
-    :ivar albums: set of albums
+    :ivar folders: list of subfolders
+    :ivar albums: list of albums
     """
 
     def __init__(self, uuid, name=None, folder_id=None):
@@ -15,9 +15,14 @@ class Folder(object):
         self.uuid = uuid
         self.id = folder_id
         self.poster_id = None
+        self.folders = []
+        self.albums = []
 
     def __repr__(self):
         return "Folder(%r, %r)" % (self.uuid, self.name)
 
     def __eq__(self, other):
         return self.uuid == other.uuid
+
+    def __ne__(self, other):
+        return not self == other
@@ -1,13 +1,20 @@
 __author__ = 'namezys'
 
+import array
+import bisect
+import itertools
+import operator
 import os
 import sqlite3
 import shutil
 import tempfile
+import time
+import urllib
 
 from album import Album
-from photo import Photo
+from photo import Photo, PhotoTable, PhotoView, image_date_ts, thumbnails
 from folder import Folder
+from snapshot import Snapshot, RACY_SECONDS, database_stamp, snapshot_path, write_snapshot
 
 from logging import getLogger
 
@@ -16,19 +23,126 @@ logger = getLogger(__name__)
 
 UNADJUSTED = "UNADJUSTEDNONRAW"
 
+LOCK_CHECK_TIMEOUT_MS = 100
+BUSY_TIMEOUT_MS = 5000
+
 LIBRARY_FOLDER = "LibraryFolder"
 TOP_LEVEL_FOLDER = "TopLevelAlbums"
+ALL_PHOTOS_ALBUM = "allPhotosAlbum"
+
+PHOTOS_QUERY = """SELECT v.uuid, v.name,
+        v.imageDate, v.lastModifiedDate, v.lastModifiedDate,
+        v.imageTimeZoneName, v.imageTimeZoneOffsetSeconds,
+        v.extendedDescription, v.isFavorite,
+        m.imagePath, v.adjustmentUuid,
+        v.modelId
+    FROM RKVersion AS v
+    JOIN RKMaster AS m ON m.uuid = v.masterUuid
+    WHERE NOT v.isInTrash AND v.type = 2"""
+# position of adjustment uuid in row of photos query
+ADJUSTMENT_COLUMN = 10
+# number of adjustments which are fetched by one query (sqlite allows 999 parameters)
+ADJUSTMENTS_BATCH = 500
+
+SNAPSHOT_VERSION = 1
+SYSTEM = ("top_folder", "library_folder", "all_photos_album", "last_import_album", "favorites")
+
+
+def adjustment_path(uuid, filename):
+    p1 = str(ord(uuid[0]))
+    p2 = str(ord(uuid[1]))
+    return os.path.join("resources/modelresources", p1, p2, uuid, filename)
+
+
+def _uri_filenames():
+    """Check if sqlite interprets file: filenames as URI (python 2 can't ask for it by itself)"""
+    db = sqlite3.connect(":memory:")
+    try:
+        return any(option.startswith("USE_URI") for option, in db.execute("PRAGMA compile_options"))
+    finally:
+        db.close()
+
+
+URI_FILENAMES = _uri_filenames()
+
+
+def connect_read_only(path):
+    """Open database for reading
+
+    Database is opened with mode=ro if sqlite is built with URI filenames, so connection can't change files.
+    Otherwise it's write-capable handle and only statements are rejected by query_only pragma:
+    closing of last connection to database in WAL mode can checkpoint and remove its write-ahead log.
+    """
+    if URI_FILENAMES:
+        path = "file:%s?mode=ro" % urllib.quote(os.path.abspath(path))
+    # rows can be fetched by stage of pipeline while connection is used by one thread at a time
+    db = sqlite3.connect(path, check_same_thread=False)
+    db.execute("PRAGMA query_only = 1")
+    return db
+
+
+def is_locked(db):
+    db.execute("PRAGMA busy_timeout = %d" % LOCK_CHECK_TIMEOUT_MS)
+    try:
+        db.execute("SELECT count(*) FROM sqlite_master").fetchone()
+    except sqlite3.OperationalError as e:
+        logger.debug("Database is locked: %s", e)
+        return True
+    finally:
+        db.execute("PRAGMA busy_timeout = %d" % BUSY_TIMEOUT_MS)
+    return False
+
+
+def _pack_album_photo_ids(sections, prefix, album_photo_ids):
+    album_ids = array.array('l', sorted(album_photo_ids))
+    offsets = array.array('l', [0])
+    photo_ids = array.array('l')
+    for album_id in album_ids:
+        photo_ids.extend(album_photo_ids[album_id])
+        offsets.append(len(photo_ids))
+    sections[prefix + ".ids"] = album_ids
+    sections[prefix + ".offsets"] = offsets
+    sections[prefix + ".photo_ids"] = photo_ids
+
+
+def _unpack_album_photo_ids(snapshot, prefix, album_ids=None):
+    ids = snapshot[prefix + ".ids"]
+    offsets = snapshot[prefix + ".offsets"]
+    photo_ids = snapshot[prefix + ".photo_ids"]
+    if album_ids is None:
+        indexes = xrange(len(ids))
+    else:
+        indexes = [bisect.bisect_left(ids, album_id) for album_id in album_ids]
+        indexes = [i for i, album_id in zip(indexes, album_ids) if i < len(ids) and ids[i] == album_id]
+    return dict((ids[i], photo_ids[offsets[i]:offsets[i + 1]]) for i in indexes)
+
+
+def _album_ids_condition(album_ids):
+    """Condition of photos query which keeps only photos of given albums"""
+    return " AND v.modelId IN (SELECT versionId FROM RKAlbumVersion WHERE albumId IN (%s))" % \
+        ",".join(str(int(album_id)) for album_id in album_ids)
+
+
+def _subtree_album_ids(folder):
+    for album in folder.albums:
+        yield album.id
+    for sub_folder in folder.folders:
+        for album_id in _subtree_album_ids(sub_folder):
+            yield album_id
+
+
+class cached_property(object):
+    """Property which is computed on first access and kept in instance"""
 
+    def __init__(self, func):
+        self.func = func
+        self.__doc__ = func.__doc__
 
-def thumbnails(path, uid):
-    base = os.path.basename(path)
-    name, ext = os.path.splitext(base)
-    mini_thumbnail = "thumb_" + name + ext
-    thumbnail = name + "_1024" + ext
-    return {
-        'mini': os.path.join("Thumbnails/", os.path.dirname(path), uid, mini_thumbnail),
-        'hd': os.path.join("Thumbnails/", os.path.dirname(path), uid, thumbnail),
-    }
+    def __get__(self, obj, cls):
+        if obj is None:
+            return self
+        value = obj.__dict__[self.func.__name__] = self.func(obj)
+        return value
 
 
 class Library(object):
@@ -36,48 +150,200 @@ class Library(object):
     LIBRARY_DB = "Library.apdb"
     IMAGE_PROXIES = "ImageProxies.apdb"
 
-    def __init__(self, path, tmp_db):
+    def __init__(self, path, tmp_db, profiler=None, cache_dir=None):
+        """
+        Databases are opened and system folders and albums are fetched on first access.
+
+        If cache directory is given, photos, folders, albums and photos of albums are read from snapshot
+        and databases aren't opened at all while snapshot is valid.
+
+        :param path: path to database directory
+        :param tmp_db: read temp copy of database if it is locked
+        :param profiler: `profiler.Profiler` to record statistics of queries
+        :param cache_dir: directory to keep snapshot of library
+        """
         self.path = path
-        library_path = os.path.join(self.path, self.LIBRARY_DB)
-        image_proxies_path = os.path.join(self.path, self.IMAGE_PROXIES)
+        self.tmp_db = tmp_db
         self.tmp_dir = None
-        if tmp_db:
-            self.tmp_dir = tempfile.mkdtemp()
-            tmp_library_path = os.path.join(self.tmp_dir, self.LIBRARY_DB)
-            tmp_image_proxies_path = os.path.join(self.tmp_dir, self.IMAGE_PROXIES)
-            shutil.copy(library_path, tmp_library_path)
-            shutil.copy(image_proxies_path, tmp_image_proxies_path)
-            library_path = tmp_library_path
-            image_proxies_path = tmp_image_proxies_path
-        self.library_db = sqlite3.connect(library_path)
-        self.image_proxies_db = sqlite3.connect(image_proxies_path)
-
-        self.top_folder = self.folder(TOP_LEVEL_FOLDER)
-        self.library_folder = self.folder(LIBRARY_FOLDER)
-        self.all_photos_album = self.album("allPhotosAlbum")
-        self.last_import_album = self.album("lastImportAlbum")
-        self.favorites = self.album("favoritesAlbum")
+        self.profiler = profiler
+        self.cache_dir = cache_dir
 
     def __del__(self):
         if self.tmp_dir:
             shutil.rmtree(self.tmp_dir)
 
+    def reset(self):
+        """Drop data which are read from databases, so they are read again on next access
+
+        Connections are kept open, but temp copies of databases are made again.
+        """
+        for name in ("snapshot", "_photo_table", "_albums") + SYSTEM:
+            self.__dict__.pop(name, None)
+        if self.tmp_dir:
+            for name in ("library_db", "image_proxies_db"):
+                db = self.__dict__.pop(name, None)
+                if db is not None:
+                    db.close()
+            shutil.rmtree(self.tmp_dir)
+            self.tmp_dir = None
+
+    @cached_property
+    def library_db(self):
+        return self._open(self.LIBRARY_DB, self.tmp_db)
+
+    @cached_property
+    def image_proxies_db(self):
+        return self._open(self.IMAGE_PROXIES, self.tmp_db)
+
+    @cached_property
+    def top_folder(self):
+        return self._system("top_folder") or self.folder(TOP_LEVEL_FOLDER)
+
+    @cached_property
+    def library_folder(self):
+        return self._system("library_folder") or self.folder(LIBRARY_FOLDER)
+
+    @cached_property
+    def all_photos_album(self):
+        return self._system("all_photos_album") or self.album(ALL_PHOTOS_ALBUM)
+
+    @cached_property
+    def last_import_album(self):
+        return self._system("last_import_album") or self.album("lastImportAlbum")
+
+    @cached_property
+    def favorites(self):
+        return self._system("favorites") or self.album("favoritesAlbum")
+
+    @cached_property
+    def snapshot(self):
+        """Snapshot of library from cache directory or None if cache isn't used
+
+        Snapshot is made again if size or modification time of any database file is changed.
+        It's also made again if files were modified just before snapshot was made,
+        because they could be changed after it without change of size and modification time.
+        """
+        if self.cache_dir is None:
+            return None
+        start = time.time()
+        path = snapshot_path(self.cache_dir, self.path)
+        stamp = database_stamp(self.path, (self.LIBRARY_DB, self.IMAGE_PROXIES))
+        key = [SNAPSHOT_VERSION, stamp]
+        snapshot = Snapshot.open(path)
+        if snapshot is not None and snapshot.key == key:
+            modified = max([0] + [mtime for _, mtime in filter(None, stamp)])
+            if modified < snapshot.mtime - RACY_SECONDS:
+                logger.info("Load snapshot %s in %.3f s", path, time.time() - start)
+                return snapshot
+        logger.info("Snapshot %s isn't valid, make it again", path)
+        source = Library(self.path, self.tmp_db, profiler=self.profiler)
+        sections = {
+            "tree": source.load_tree(),
+            "system": dict((name, getattr(source, name)) for name in SYSTEM),
+        }
+        for name, column in source.fetch_photo_table().columns().iteritems():
+            sections["photos." + name] = column
+        _pack_album_photo_ids(sections, "albums", source.fetch_album_photo_ids())
+        _pack_album_photo_ids(sections, "albums_by_date", source.fetch_album_photo_ids(date_order=True))
+        try:
+            write_snapshot(path, key, sections)
+        except EnvironmentError as e:
+            logger.warning("Can't write snapshot %s: %s", path, e)
+            return None
+        logger.info("Make snapshot in %.3f s", time.time() - start)
+        return Snapshot.open(path)
+
+    @cached_property
+    def _photo_table(self):
+        return PhotoTable.from_columns(dict((name, self.snapshot["photos." + name])
+                                            for name in PhotoTable.ARRAY_COLUMNS + PhotoTable.LIST_COLUMNS))
+
+    @cached_property
+    def _albums(self):
+        albums = dict((album.uuid, album) for folder in self.snapshot["tree"].itervalues() for album in folder.albums)
+        for name in SYSTEM:
+            album = self._system(name)
+            albums[album.uuid] = album
+        return albums
+
+    def _system(self, name):
+        if self.snapshot is None:
+            return None
+        return self.snapshot["system"][name]
+
+    def _open(self, name, tmp_db):
+        """Open database read-only in place
+
+        Temp copy of database (with its write-ahead log) is made only if database is locked and `tmp_db` is set.
+        """
+        start = time.time()
+        path = os.path.join(self.path, name)
+        db = connect_read_only(path)
+        strategy = "in place"
+        if tmp_db and is_locked(db):
+            db.close()
+            if self.tmp_dir is None:
+                self.tmp_dir = tempfile.mkdtemp()
+            tmp_path = os.path.join(self.tmp_dir, name)
+            shutil.copy(path, tmp_path)
+            if os.path.exists(path + "-wal"):
+                shutil.copy(path + "-wal", tmp_path + "-wal")
+            db = connect_read_only(tmp_path)
+            strategy = "temp copy"
+        logger.info("Open %s (%s) in %.3f s", name, strategy, time.time() - start)
+        if self.profiler:
+            return self.profiler.connection(db)
+        return db
+
     def get_adjustment(self, adjustment):
-        cursor = self.image_proxies_db.cursor()
-        cursor.execute("SELECT resourceUuid, filename FROM RKModelResource WHERE resourceTag=?", [adjustment])
+        cursor = self.image_proxies_db.execute("SELECT resourceUuid, filename FROM RKModelResource WHERE resourceTag=?",
+                                               [adjustment])
         uuid, filename = cursor.fetchone()
-        p1 = str(ord(uuid[0]))
-        p2 = str(ord(uuid[1]))
-        return os.path.join("resources/modelresources", p1, p2, uuid, filename)
+        return adjustment_path(uuid, filename)
+
+    def fetch_adjustments(self, tags=None):
+        """Get paths of all adjustments or only of given ones by one query
+
+        :return: dict of adjustment uuid to path
+        """
+        query = "SELECT resourceTag, resourceUuid, filename FROM RKModelResource"
+        if tags is None:
+            logger.info("Fetch adjustments")
+            cursor = self.image_proxies_db.execute(query)
+        else:
+            tags = list(tags)
+            cursor = self.image_proxies_db.execute(query + " WHERE resourceTag IN (%s)" % ",".join("?" * len(tags)),
+                                                   tags)
+        adjustments = dict()
+        for tag, uuid, filename in cursor:
+            if tag not in adjustments:
+                adjustments[tag] = adjustment_path(uuid, filename)
+        return adjustments
+
+    def _with_adjustments(self, rows, adjustments):
+        """Fetch adjustments of photos rows by batches
+
+        Adjustments of batch of rows are fetched by one query and added to `adjustments` before rows are yielded,
+        so only adjustments of part of library are read.
+        """
+        rows = iter(rows)
+        for batch in iter(lambda: list(itertools.islice(rows, ADJUSTMENTS_BATCH)), []):
+            tags = set(row[ADJUSTMENT_COLUMN] for row in batch)
+            tags.discard(UNADJUSTED)
+            tags.difference_update(adjustments)
+            if tags:
+                adjustments.update(self.fetch_adjustments(tags))
+            for row in batch:
+                yield row
 
     def _photo(self, uuid, name, data_ts, date_tz, description, orig_path_db, adjustment, photo_id,
-               change_ts, change_meta_ts, tz_offset, favorite):
+               change_ts, change_meta_ts, tz_offset, favorite, adjustments):
         logger.debug("Got photo %s (%s)", name, uuid)
         orig_path = os.path.join("Masters", orig_path_db)
         if adjustment == UNADJUSTED:
             path = orig_path
         else:
-            path = self.get_adjustment(adjustment)
+            path = adjustments[adjustment]
         return Photo(uuid, name=name, description=description,
                      image_date_ts=data_ts, time_zone=date_tz, time_zone_offset=tz_offset,
                      path=path, original_path=orig_path,
@@ -86,13 +352,24 @@ class Library(object):
                      is_favorite=bool(favorite))
 
     def album(self, uuid):
+        """Get album by uuid
+
+        :raise KeyError: if there is no such album
+        """
+        if self.snapshot is not None and uuid in self._albums:
+            return self._albums[uuid]
         cursor = self.library_db.execute("""SELECT name, modelId,
                                                 (SELECT modelId FROM RKVersion WHERE uuid = a.posterVersionUuid)
                                             FROM RKAlbum AS a WHERE uuid = ?""", [uuid])
-        name, album_id, poster_id = cursor.fetchone()
+        row = cursor.fetchone()
+        if row is None:
+            raise KeyError(uuid)
+        name, album_id, poster_id = row
         return Album(uuid, name=name, album_id=album_id, poster_id=poster_id)
 
     def folder(self, uuid):
+        if self.snapshot is not None and uuid in self.snapshot["tree"]:
+            return self.snapshot["tree"][uuid]
         cursor = self.library_db.execute("SELECT name, modelId FROM RKFolder WHERE uuid = ?", [uuid])
         name, folder_id = cursor.fetchone()
         return Folder(uuid, name=name, folder_id=folder_id)
@@ -128,6 +405,71 @@ class Library(object):
             logger.debug("Got album %s (%s)", name, uuid)
             yield Album(uuid, name, album_id, poster_id=poster_id)
 
+    def load_tree(self):
+        """Load all folders and albums by one query for each table
+
+        Subfolders and albums are in the same order as `fetch_subfolders` and `fetch_albums` return them.
+
+        :return: dict of folders by uuid with filled `folders` and `albums`
+        """
+        if self.snapshot is not None:
+            return self.snapshot["tree"]
+        logger.info("Load folders and albums")
+        folders = dict()
+        subfolders = []
+        implicit_albums = set()
+        cursor = self.library_db.execute("""SELECT uuid, name, modelId, parentFolderUuid, implicitAlbumUuid, isInTrash
+                                            FROM RKFolder""")
+        for uuid, name, folder_id, parent_uuid, implicit_album_uuid, is_in_trash in cursor:
+            folder = Folder(uuid, name, folder_id=folder_id)
+            folders[uuid] = folder
+            implicit_albums.add(implicit_album_uuid)
+            if not is_in_trash:
+                subfolders.append((parent_uuid, folder))
+        for parent_uuid, folder in subfolders:
+            if parent_uuid in folders:
+                folders[parent_uuid].folders.append(folder)
+        cursor = self.library_db.execute("""SELECT a.uuid, a.name, a.modelId, v.modelId, a.folderUuid
+                                            FROM RKAlbum AS a
+                                            LEFT JOIN RKVersion AS v ON v.uuid = a.posterVersionUuid
+                                            WHERE NOT a.isInTrash AND a.name NOT NULL""")
+        for uuid, name, album_id, poster_id, folder_uuid in cursor:
+            if uuid in implicit_albums or folder_uuid not in folders:
+                continue
+            folders[folder_uuid].albums.append(Album(uuid, name, album_id, poster_id=poster_id))
+        logger.debug("Got %s folders", len(folders))
+        return folders
+
+    def scope(self, folder=None, album=None):
+        """Get root folder of exported subtree and ids of its albums
+
+        If album is given, root is top folder which contains only this album.
+
+        :param folder: uuid of folder or path of names of folders from top folder separated by slash
+        :param album: uuid of album
+        :raise KeyError: if folder or album isn't found
+        :return: root folder and list of album ids or None if whole library is exported
+        """
+        tree = self.load_tree()
+        top = tree[self.top_folder.uuid]
+        if album is not None:
+            album = self.album(album)
+            root = Folder(top.uuid, top.name, folder_id=top.id)
+            root.albums.append(album)
+            return root, [album.id]
+        if folder is None:
+            return top, None
+        if folder in tree:
+            root = tree[folder]
+        else:
+            root = top
+            for name in folder.strip("/").split("/"):
+                sub_folders = [f for f in root.folders if f.name == name]
+                if not sub_folders:
+                    raise KeyError(folder)
+                root = sub_folders[0]
+        return root, list(_subtree_album_ids(root))
+
     def fetch_album_photo_id_list(self, album):
         logger.info("Fetch photo ids of %s", album)
         if album == self.all_photos_album:
@@ -137,25 +479,173 @@ class Library(object):
             cursor = self.library_db.execute("""SELECT av.versionId
                 FROM RKAlbumVersion AS av
                 JOIN RKAlbum AS a ON a.modelId = av.albumId
-                JOIN RKVersion AS v
+                JOIN RKVersion AS v ON v.modelId = av.versionId
                 WHERE NOT v.isInTrash AND v.type = 2 AND a.uuid = ?""", [album.uuid])
         return (row[0] for row in cursor)
 
-    def fetch_photos(self):
-        """Get photos
+    def fetch_album_photo_ids(self, date_order=False, album_ids=None):
+        """Get photo ids of all albums by one query
+
+        :param date_order: order photo ids by image date instead of id
+        :param album_ids: get only photo ids of these albums
+        :return: dict of album id to array of photo ids sorted by id (or by image date if `date_order` is set)
         """
-        logger.info("Fetch photos")
-        cursor = self.library_db.cursor()
-        cursor.execute("""SELECT v.uuid, v.name,
-                v.imageDate, v.lastModifiedDate, v.lastModifiedDate,
-                v.imageTimeZoneName, v.imageTimeZoneOffsetSeconds,
-                v.extendedDescription, v.isFavorite,
-                m.imagePath, v.adjustmentUuid,
-                v.modelId
+        if self.snapshot is not None:
+            return _unpack_album_photo_ids(self.snapshot, "albums_by_date" if date_order else "albums", album_ids)
+        logger.info("Fetch photo ids of all albums")
+        condition = ""
+        if album_ids is not None:
+            condition = " AND av.albumId IN (%s)" % ",".join(str(int(album_id)) for album_id in album_ids)
+        # TODO: append video
+        cursor = self.library_db.execute("""SELECT DISTINCT av.albumId, av.versionId, v.imageDate
+            FROM RKAlbumVersion AS av
+            JOIN RKVersion AS v ON v.modelId = av.versionId
+            WHERE NOT v.isInTrash AND v.type = 2""" + condition + """
+            ORDER BY av.albumId, """ + ("v.imageDate, av.versionId" if date_order else "av.versionId"))
+        album_photo_ids = dict()
+        for album_id, rows in itertools.groupby(cursor, operator.itemgetter(0)):
+            album_photo_ids[album_id] = array.array('l', (photo_id for _, photo_id, _ in rows))
+        return album_photo_ids
+
+    def fetch_photo_summary(self, album_ids=None):
+        """Get id, favorite flag, image date and modification date of photos
+
+        Photos are in the same order as `fetch_photos` returns them.
+
+        :param album_ids: get only photos of these albums
+        """
+        if self.snapshot is not None:
+            return ((p.id, p.is_favorite, p.image_date_ts, p.export_image_change_date_ts)
+                    for p in self._snapshot_photos(album_ids=album_ids))
+        logger.info("Fetch photo summary")
+        query = """SELECT v.modelId, v.isFavorite, v.imageDate, v.lastModifiedDate
             FROM RKVersion AS v
             JOIN RKMaster AS m ON m.uuid = v.masterUuid
-            WHERE NOT v.isInTrash AND v.type = 2""")
+            WHERE NOT v.isInTrash AND v.type = 2"""
+        if album_ids is not None:
+            query += _album_ids_condition(album_ids)
+        return self.library_db.execute(query)
+
+    def _fetch_photo_rows(self, key_order=False, modified_since=None, album_ids=None):
+        query = PHOTOS_QUERY
+        params = []
+        if album_ids is not None:
+            query += _album_ids_condition(album_ids)
+        if modified_since is not None:
+            query += " AND v.lastModifiedDate >= ?"
+            params.append(modified_since)
+        if key_order:
+            query += " ORDER BY CAST(v.modelId AS TEXT)"
+        return self.library_db.execute(query, params)
+
+    def _scope_photo_ids(self, album_ids):
+        photo_ids = set()
+        for album_photo_ids in self.fetch_album_photo_ids(album_ids=album_ids).itervalues():
+            photo_ids.update(album_photo_ids)
+        return photo_ids
+
+    def _snapshot_photos(self, key_order=False, modified_since=None, album_ids=None):
+        table = self._photo_table
+        if album_ids is None:
+            rows = xrange(len(table))
+        else:
+            rows = sorted(table.rows[i] for i in self._scope_photo_ids(album_ids) if i in table.rows)
+        if modified_since is not None:
+            rows = (row for row in rows if table.change_dates[row] >= modified_since)
+        if key_order:
+            rows = sorted(rows, key=lambda row: str(table.ids[row]))
+        return (PhotoView(table, row) for row in rows)
+
+    def fetch_photos(self, key_order=False, modified_since=None, album_ids=None):
+        """Get photos
+
+        :param key_order: order photos by id as string like keys of plist dict
+        :param modified_since: get only photos which were modified at this time or later
+        :param album_ids: get only photos of these albums
+        """
+        if self.snapshot is not None:
+            for photo in self._snapshot_photos(key_order, modified_since, album_ids):
+                yield photo
+            return
+        logger.info("Fetch photos")
+        rows = self._fetch_photo_rows(key_order, modified_since, album_ids)
+        adjustments = None
+        if album_ids is not None:
+            adjustments = dict()
+            rows = self._with_adjustments(rows, adjustments)
+        for photo in self._photos(rows, adjustments):
+            yield photo
+
+    def query(self, album=None, favorite=None, date_from=None, date_to=None, limit=None):
+        """Get photos which match all given conditions ordered by image date
+
+        Conditions are checked by database, so only matched photos and their adjustments are read.
+
+        :param album: album or its uuid, all photos album doesn't restrict photos
+        :param favorite: get only favorite photos if True or only not favorite ones if False
+        :param date_from: get photos which are taken at this date or later
+        :param date_to: get photos which are taken before this date
+        :param limit: maximal number of photos
+        """
+        query = PHOTOS_QUERY
+        params = []
+        album = getattr(album, "uuid", album)
+        if album is not None and album != ALL_PHOTOS_ALBUM:
+            query += """ AND v.modelId IN (SELECT av.versionId
+                FROM RKAlbumVersion AS av
+                JOIN RKAlbum AS a ON a.modelId = av.albumId
+                WHERE a.uuid = ?)"""
+            params.append(album)
+        if favorite is not None:
+            query += " AND v.isFavorite = ?"
+            params.append(int(favorite))
+        if date_from is not None:
+            query += " AND v.imageDate >= ?"
+            params.append(image_date_ts(date_from))
+        if date_to is not None:
+            query += " AND v.imageDate < ?"
+            params.append(image_date_ts(date_to))
+        query += " ORDER BY v.imageDate, v.modelId"
+        if limit is not None:
+            query += " LIMIT ?"
+            params.append(limit)
+        logger.info("Query photos")
+        adjustments = dict()
+        return self._photos(self._with_adjustments(self.library_db.execute(query, params), adjustments), adjustments)
+
+    def _photos(self, rows, adjustments=None):
         for uuid, name, data_ts, change_ts, change_meta_ts, date_tz, tz_offset,\
-                description, favorite, orig_path_db, adjustment, photo_id in cursor:
+                description, favorite, orig_path_db, adjustment, photo_id in rows:
+            if adjustments is None and adjustment != UNADJUSTED:
+                adjustments = self.fetch_adjustments()
             yield self._photo(uuid, name, data_ts, date_tz, description, orig_path_db, adjustment, photo_id,
-                              change_ts, change_meta_ts, tz_offset, favorite)
+                              change_ts, change_meta_ts, tz_offset, favorite, adjustments)
+
+    def fetch_photo_table(self, album_ids=None):
+        """Get photos as `PhotoTable`
+
+        Rows are appended without creation of object for each photo.
+
+        :param album_ids: get only photos of these albums
+        """
+        if self.snapshot is not None:
+            if album_ids is not None:
+                return self._photo_table.select(self._scope_photo_ids(album_ids))
+            return self._photo_table
+        logger.info("Fetch photo table")
+        table = PhotoTable()
+        rows = self._fetch_photo_rows(album_ids=album_ids)
+        adjustments = None
+        if album_ids is not None:
+            adjustments = dict()
+            rows = self._with_adjustments(rows, adjustments)
+        for uuid, name, data_ts, change_ts, change_meta_ts, date_tz, tz_offset,\
+                description, favorite, orig_path_db, adjustment, photo_id in rows:
+            path = None
+            if adjustment != UNADJUSTED:
+                if adjustments is None:
+                    adjustments = self.fetch_adjustments()
+                path = adjustments[adjustment]
+            table.append(uuid, name, data_ts, date_tz, description, orig_path_db, path, photo_id,
+                         change_ts, change_meta_ts, tz_offset, favorite)
+        return table
@@ -0,0 +1,73 @@
+__author__ = 'namezys'
+
+import binascii
+import itertools
+import string
+
+_BITS = string.maketrans("01", "\0\1")
+
+# set with less than one of this number of all photos is kept as sorted ids instead of bitmap
+SPARSE_RATIO = 32
+
+
+def is_bitmap(photo_set):
+    return isinstance(photo_set, (int, long))
+
+
+class Membership(object):
+    """Photos of albums and folders as sorted ids or bitmaps
+
+    Small sets are kept as sorted sequences of photo ids. Large sets are kept as bitmaps:
+    python long where bit of each photo id is set, so union of large sets is bitwise or
+    which is done in one pass over machine words.
+    Photo ids are converted to strings once and these strings are shared by key lists of all albums and folders.
+    """
+
+    def __init__(self, photo_ids):
+        """
+        :param photo_ids: all photo ids which can be members of albums
+        """
+        photo_ids = list(photo_ids)
+        self.photo_keys = [None] * (max(photo_ids) + 1 if photo_ids else 0)
+        for photo_id in photo_ids:
+            if self.photo_keys[photo_id] is None:
+                self.photo_keys[photo_id] = str(photo_id)
+
+    def key(self, photo_id):
+        return self.photo_keys[photo_id]
+
+    def keys(self, photo_set):
+        """Get keys of photos of set in order of ids"""
+        if is_bitmap(photo_set):
+            if not photo_set:
+                return []
+            bits = bytearray(bin(photo_set)[:1:-1].translate(_BITS))
+            return list(itertools.compress(self.photo_keys, bits))
+        return map(self.photo_keys.__getitem__, photo_set)
+
+    @staticmethod
+    def bitmap(photo_ids):
+        """Make bitmap of photo ids"""
+        if not len(photo_ids):
+            return 0
+        buf = bytearray(max(photo_ids) // 8 + 1)
+        for photo_id in photo_ids:
+            buf[photo_id >> 3] |= 1 << (photo_id & 7)
+        buf.reverse()
+        return int(binascii.hexlify(buf), 16)
+
+    def union(self, photo_sets):
+        """Union of sets of photos
+
+        Result is sorted ids if all sets are sorted ids and they are small together, otherwise it's bitmap.
+        """
+        if not any(is_bitmap(s) for s in photo_sets) and \
+                sum(len(s) for s in photo_sets) * SPARSE_RATIO < len(self.photo_keys):
+            photo_ids = set()
+            for photo_set in photo_sets:
+                photo_ids.update(photo_set)
+            return sorted(photo_ids)
+        bitmap = 0
+        for photo_set in photo_sets:
+            bitmap |= photo_set if is_bitmap(photo_set) else self.bitmap(photo_set)
+        return bitmap
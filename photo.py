@@ -1,6 +1,9 @@
 __author__ = 'namezys'
 
+import array
+import calendar
 import datetime
+import os
 import pytz
 import time
 
@@ -10,18 +13,82 @@ logger = getLogger(__name__)
 
 TIME_OFFSET = datetime.timedelta(11323)
 
+MASTERS = "Masters"
+
+
+_time_zones = dict()
+
 
 def tz(tzname):
     if not tzname:
         return None
     try:
-        return pytz.timezone(tzname)
+        return _time_zones[tzname]
+    except KeyError:
+        pass
+    try:
+        zone = pytz.timezone(tzname)
     except pytz.UnknownTimeZoneError:
-        logger.debug("Can't found time zone %s", tz)
-        return None
+        logger.debug("Can't found time zone %s", tzname)
+        zone = None
+    _time_zones[tzname] = zone
+    return zone
+
+
+def image_date_ts(date):
+    """Timestamp of image which `BasePhoto.date` is given for
+
+    Naive date is in UTC.
+    """
+    if date.tzinfo is not None:
+        date = date.astimezone(pytz.utc).replace(tzinfo=None)
+    date -= TIME_OFFSET
+    return calendar.timegm(date.timetuple()) + date.microsecond / 1e6 + 3600
+
+
+def thumbnails(path, uid):
+    base = os.path.basename(path)
+    name, ext = os.path.splitext(base)
+    mini_thumbnail = "thumb_" + name + ext
+    thumbnail = name + "_1024" + ext
+    return {
+        'mini': os.path.join("Thumbnails/", os.path.dirname(path), uid, mini_thumbnail),
+        'hd': os.path.join("Thumbnails/", os.path.dirname(path), uid, thumbnail),
+    }
+
+
+class BasePhoto(object):
+    """Properties which are computed from fields of photo"""
+
+    __slots__ = ()
+
+    @property
+    def image_data_gmt_ts(self):
+        return self.image_date_ts + self.time_zone_offset
+
+    @property
+    def date(self):
+        return datetime.datetime.fromtimestamp(self.image_date_ts - 3600, tz(self.time_zone)) + TIME_OFFSET
 
+    @property
+    def sort_key(self):
+        """Key to sort photos by date without computing of it
+
+        `date` is an instant given by image timestamp, so order is the same.
+        """
+        return self.image_date_ts
+
+    def __eq__(self, other):
+        return self.uuid == other.uuid
+
+    def __ne__(self, other):
+        return not self == other
 
-class Photo(object):
+    def __hash__(self):
+        return hash(self.uuid)
+
+
+class Photo(BasePhoto):
     """One photo in library
 
     :ivar title: title of photo
@@ -31,6 +98,10 @@ class Photo(object):
     ;ivar original: Path to original file with photo
     """
 
+    __slots__ = ("uuid", "name", "path", "original", "description", "is_favorite", "thumbnails", "id",
+                 "time_zone", "time_zone_offset", "image_date_ts",
+                 "export_image_change_date_ts", "export_metadata_change_date_ts")
+
     def __init__(self, uuid, name,
                  path=None,
                  original_path=None,
@@ -58,13 +129,198 @@ class Photo(object):
         self.export_image_change_date_ts = export_image_change_date_ts
         self.export_metadata_change_date_ts = export_metadata_change_date_ts
 
+
+def _timestamp(value):
+    if value != value:
+        return None
+    if value.is_integer():
+        # like SQLite returns value of NUMERIC column
+        return int(value)
+    return value
+
+
+class PhotoView(BasePhoto):
+    """Photo which is stored in row of `PhotoTable`"""
+
+    __slots__ = ("table", "row")
+
+    def __init__(self, table, row):
+        self.table = table
+        self.row = row
+
     @property
-    def image_data_gmt_ts(self):
-        return self.image_date_ts + self.time_zone_offset
+    def id(self):
+        return self.table.ids[self.row]
 
     @property
-    def date(self):
-        return datetime.datetime.fromtimestamp(self.image_date_ts - 3600, tz(self.time_zone)) + TIME_OFFSET
+    def uuid(self):
+        return self.table.uuids[self.row]
 
-    def __eq__(self, other):
-        return self.uuid == other.uuid
+    @property
+    def name(self):
+        return self.table.names[self.row]
+
+    @property
+    def description(self):
+        return self.table.descriptions[self.row]
+
+    @property
+    def is_favorite(self):
+        return bool(self.table.favorites[self.row])
+
+    @property
+    def original(self):
+        return os.path.join(MASTERS, self.table.original_path(self.row))
+
+    @property
+    def path(self):
+        return self.table.paths[self.row] or self.original
+
+    @property
+    def thumbnails(self):
+        return thumbnails(self.table.original_path(self.row), self.uuid)
+
+    @property
+    def time_zone(self):
+        return self.table.strings[self.table.time_zones[self.row]]
+
+    @property
+    def time_zone_offset(self):
+        return self.table.time_zone_offsets[self.row]
+
+    @property
+    def image_date_ts(self):
+        return _timestamp(self.table.image_dates[self.row])
+
+    @property
+    def export_image_change_date_ts(self):
+        return _timestamp(self.table.change_dates[self.row])
+
+    @property
+    def export_metadata_change_date_ts(self):
+        return _timestamp(self.table.metadata_change_dates[self.row])
+
+
+class PhotoTable(object):
+    """Photos stored by columns
+
+    Numbers are kept in arrays, directories of originals and time zones are interned.
+    Table is a mapping of photo id to `PhotoView` and it's iterated in the same order as dict of photos.
+    Missing timestamps are kept as NaN, integral ones are got as int like they are read from database.
+
+    :ivar rows: dict of photo id to row
+    :ivar paths: path of adjusted photo or None if photo isn't adjusted
+    """
+
+    ARRAY_COLUMNS = ("ids", "favorites", "original_dirs", "time_zones", "time_zone_offsets",
+                     "image_dates", "change_dates", "metadata_change_dates")
+    LIST_COLUMNS = ("uuids", "names", "descriptions", "paths", "original_names", "strings")
+
+    def __init__(self):
+        self.rows = dict()
+        self.ids = array.array('l')
+        self.uuids = []
+        self.names = []
+        self.descriptions = []
+        self.favorites = array.array('b')
+        self.paths = []
+        self.original_dirs = array.array('l')
+        self.original_names = []
+        self.time_zones = array.array('l')
+        self.time_zone_offsets = array.array('l')
+        self.image_dates = array.array('d')
+        self.change_dates = array.array('d')
+        self.metadata_change_dates = array.array('d')
+        self.strings = []
+        self.string_index = dict()
+
+    def _intern(self, value):
+        index = self.string_index.get(value)
+        if index is None:
+            index = self.string_index[value] = len(self.strings)
+            self.strings.append(value)
+        return index
+
+    def append(self, uuid, name, data_ts, date_tz, description, orig_path_db, adjustment_path, photo_id,
+               change_ts, change_meta_ts, tz_offset, favorite):
+        """Append photo
+
+        :param orig_path_db: path of original in `Masters`
+        :param adjustment_path: path of adjusted photo or None
+        """
+        self.rows[photo_id] = len(self.ids)
+        self.ids.append(photo_id)
+        self.uuids.append(uuid)
+        self.names.append(name)
+        self.descriptions.append(description)
+        self.favorites.append(bool(favorite))
+        self.paths.append(adjustment_path)
+        original_dir, original_name = os.path.split(orig_path_db)
+        self.original_dirs.append(self._intern(original_dir))
+        self.original_names.append(original_name)
+        self.time_zones.append(self._intern(date_tz))
+        self.time_zone_offsets.append(tz_offset or 0)
+        nan = float("nan")
+        self.image_dates.append(nan if data_ts is None else data_ts)
+        self.change_dates.append(nan if change_ts is None else change_ts)
+        self.metadata_change_dates.append(nan if change_meta_ts is None else change_meta_ts)
+
+    def columns(self):
+        """Dict of column name to array or list"""
+        return dict((name, getattr(self, name)) for name in self.ARRAY_COLUMNS + self.LIST_COLUMNS)
+
+    @classmethod
+    def from_columns(cls, columns):
+        """Make table from columns which are got by `columns`"""
+        table = cls()
+        for name in cls.ARRAY_COLUMNS + cls.LIST_COLUMNS:
+            setattr(table, name, columns[name])
+        for row, photo_id in enumerate(table.ids):
+            table.rows[photo_id] = row
+        for index, value in enumerate(table.strings):
+            table.string_index[value] = index
+        return table
+
+    def select(self, photo_ids):
+        """Make table of given photos in order of rows of this table
+
+        Interned strings are shared with this table. Photos which aren't in table are skipped.
+        """
+        table = PhotoTable()
+        table.strings = self.strings
+        table.string_index = self.string_index
+        names = [name for name in self.ARRAY_COLUMNS + self.LIST_COLUMNS if name != "strings"]
+        for row in sorted(self.rows[i] for i in photo_ids if i in self.rows):
+            table.rows[self.ids[row]] = len(table.ids)
+            for name in names:
+                getattr(table, name).append(getattr(self, name)[row])
+        return table
+
+    def original_path(self, row):
+        """Path of original in `Masters`"""
+        return os.path.join(self.strings[self.original_dirs[row]], self.original_names[row])
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, photo_id):
+        return photo_id in self.rows
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def __getitem__(self, photo_id):
+        return PhotoView(self, self.rows[photo_id])
+
+    def get(self, photo_id, default=None):
+        row = self.rows.get(photo_id)
+        return default if row is None else PhotoView(self, row)
+
+    def keys(self):
+        return self.rows.keys()
+
+    def itervalues(self):
+        return (PhotoView(self, row) for row in self.rows.itervalues())
+
+    def values(self):
+        return list(self.itervalues())
@@ -0,0 +1,296 @@
+__author__ = 'namezys'
+
+import BaseHTTPServer
+import Queue
+import SocketServer
+import contextlib
+import hashlib
+import json
+import logging
+import mimetypes
+import os
+import shutil
+import threading
+import urllib
+import urlparse
+
+from argparse import ArgumentParser, ArgumentTypeError
+
+from library import Library
+from photos_tool import parse_date
+from snapshot import DEFAULT_CACHE_DIR, database_stamp
+
+try:
+    from sendfile import sendfile
+except ImportError:
+    sendfile = None
+
+logger = logging.getLogger(__name__)
+
+DESCR = "Serve photos library metadata and thumbnails by HTTP"
+
+THUMBNAILS = "Thumbnails"
+JSON_TYPE = "application/json"
+CHUNK_SIZE = 1 << 20
+
+
+class BadRequest(Exception):
+    pass
+
+
+class NotFound(Exception):
+    pass
+
+
+def photo_json(photo):
+    return {
+        "id": photo.id,
+        "uuid": photo.uuid,
+        "name": photo.name,
+        "description": photo.description,
+        "is_favorite": photo.is_favorite,
+        "date": photo.date.isoformat() if photo.image_date_ts is not None else None,
+        "image_date_ts": photo.image_date_ts,
+        "time_zone": photo.time_zone,
+        "path": photo.path,
+        "original": photo.original,
+        "thumbnails": photo.thumbnails,
+    }
+
+
+def album_json(album):
+    return {"uuid": album.uuid, "name": album.name, "id": album.id, "poster_id": album.poster_id}
+
+
+def folder_json(folder):
+    return {
+        "uuid": folder.uuid,
+        "name": folder.name,
+        "id": folder.id,
+        "folders": [folder_json(f) for f in folder.folders],
+        "albums": [album_json(a) for a in folder.albums],
+    }
+
+
+def _flag(value):
+    if value.lower() in ("1", "true", "yes"):
+        return True
+    if value.lower() in ("0", "false", "no"):
+        return False
+    raise BadRequest("%r isn't boolean" % value)
+
+
+def _query_filters(query):
+    """Get arguments of `Library.query` from query string"""
+    params = urlparse.parse_qs(query)
+    filters = dict()
+    for name, values in params.items():
+        value = values[-1]
+        if name == "album":
+            filters[name] = value
+        elif name == "favorite":
+            filters[name] = _flag(value)
+        elif name in ("date_from", "date_to"):
+            try:
+                filters[name] = parse_date(value)
+            except ArgumentTypeError as e:
+                raise BadRequest(str(e))
+        elif name == "limit":
+            if not value.isdigit():
+                raise BadRequest("%r isn't number" % value)
+            filters[name] = int(value)
+        else:
+            raise BadRequest("Unknown parameter %r" % name)
+    return filters
+
+
+class LibraryPool(object):
+    """Libraries which are shared by threads of server
+
+    Each library has its own connections, so it's used by one thread at a time.
+    Library is reset before use if databases are changed since it was used last time.
+    """
+
+    def __init__(self, path, size, tmp_db=True, cache_dir=None):
+        self.generation = 0
+        self.free = Queue.Queue()
+        for _ in range(size):
+            self.free.put((Library(path, tmp_db, cache_dir=cache_dir), self.generation))
+
+    @contextlib.contextmanager
+    def library(self):
+        library, generation = self.free.get()
+        current = self.generation
+        try:
+            if generation != current:
+                library.reset()
+            yield library
+        finally:
+            self.free.put((library, current))
+
+
+class PhotoServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Server of library
+
+    JSON responses are cached until size or modification time of any database file is changed.
+
+    :ivar photos_path: path to photos directory
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, photos_path, connections=4, tmp_db=True, cache_dir=None):
+        BaseHTTPServer.HTTPServer.__init__(self, address, Handler)
+        self.photos_path = os.path.abspath(photos_path)
+        self.thumbnails_path = os.path.realpath(os.path.join(self.photos_path, THUMBNAILS))
+        self.db_path = os.path.join(self.photos_path, "database")
+        self.pool = LibraryPool(self.db_path, connections, tmp_db, cache_dir)
+        self.lock = threading.Lock()
+        self.responses = dict()
+        self.stamp = self._stamp()
+
+    def _stamp(self):
+        return database_stamp(self.db_path, (Library.LIBRARY_DB, Library.IMAGE_PROXIES))
+
+    def response(self, key, make):
+        """Get cached body and ETag of JSON response or make it
+
+        :param make: function which gets library and returns object to serialize
+        """
+        stamp = self._stamp()
+        with self.lock:
+            if stamp != self.stamp:
+                logger.info("Database is changed, drop %s responses", len(self.responses))
+                self.responses.clear()
+                self.stamp = stamp
+                self.pool.generation += 1
+            cached = self.responses.get(key)
+        if cached is not None:
+            return cached
+        with self.pool.library() as library:
+            body = json.dumps(make(library), separators=(",", ":"))
+        cached = body, '"%s"' % hashlib.md5(body).hexdigest()
+        with self.lock:
+            if stamp == self.stamp:
+                self.responses[key] = cached
+        return cached
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "mac_photos"
+    # headers and small bodies are sent by one packet, it's flushed after each request
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        parts = [urllib.unquote(p) for p in url.path.strip("/").split("/")]
+        try:
+            if parts == ["photos"]:
+                filters = _query_filters(url.query)
+                self._json(url, lambda library: [photo_json(p) for p in (
+                    library.query(**filters) if filters else library.fetch_photos())])
+            elif parts == ["tree"]:
+                self._json(url, lambda library: folder_json(library.load_tree()[library.top_folder.uuid]))
+            elif len(parts) == 2 and parts[0] == "albums":
+                self._json(url, lambda library: self._album(library, parts[1]))
+            elif parts[0] == THUMBNAILS:
+                self._file(os.path.join(self.server.photos_path, *parts))
+            else:
+                self.send_error(404)
+        except BadRequest as e:
+            self.send_error(400, str(e))
+        except NotFound as e:
+            self.send_error(404, str(e))
+
+    @staticmethod
+    def _album(library, uuid):
+        try:
+            data = album_json(library.album(uuid))
+        except KeyError:
+            raise NotFound("Album %s isn't found" % uuid)
+        data["photos"] = [photo_json(p) for p in library.query(album=uuid)]
+        return data
+
+    def _not_modified(self, etag):
+        if etag not in (t.strip() for t in self.headers.get("If-None-Match", "").split(",")):
+            return False
+        self.send_response(304)
+        self.send_header("ETag", etag)
+        self.end_headers()
+        return True
+
+    def _json(self, url, make):
+        body, etag = self.server.response(url.path + "?" + url.query, make)
+        if self._not_modified(etag):
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", JSON_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _file(self, path):
+        path = os.path.realpath(path)
+        if not path.startswith(self.server.thumbnails_path + os.sep) or not os.path.isfile(path):
+            self.send_error(404)
+            return
+        with open(path, "rb") as f:
+            stat = os.fstat(f.fileno())
+            etag = '"%x-%x"' % (int(stat.st_mtime * 1000000), stat.st_size)
+            if self._not_modified(etag):
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", mimetypes.guess_type(path)[0] or "application/octet-stream")
+            self.send_header("Content-Length", str(stat.st_size))
+            self.send_header("ETag", etag)
+            self.end_headers()
+            self.wfile.flush()
+            if sendfile is None:
+                shutil.copyfileobj(f, self.wfile, CHUNK_SIZE)
+                return
+            offset = 0
+            while offset < stat.st_size:
+                sent = sendfile(self.connection.fileno(), f.fileno(), offset, min(CHUNK_SIZE, stat.st_size - offset))
+                if not sent:
+                    break
+                offset += sent
+
+    def log_message(self, log_format, *args):
+        logger.debug("%s " + log_format, self.address_string(), *args)
+
+
+def main():
+    parser = ArgumentParser(description=DESCR)
+    parser.add_argument("--path", "-p", required=True, help="Path to photos directory", default=".")
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen")
+    parser.add_argument("--port", type=int, default=8000, help="Port to listen")
+    parser.add_argument("--connections", type=int, default=4, help="Number of libraries shared by requests")
+    parser.add_argument("--tmp-db", action="store_true", help="Create temp copy of db if it is locked")
+    parser.add_argument("--cache-dir", default=DEFAULT_CACHE_DIR, help="Directory to keep snapshot of library")
+    parser.add_argument("--no-cache", action="store_true", help="Read databases without snapshot of library")
+
+    parser.add_argument("--log-level",
+                        choices=['INFO', 'WARNING', 'DEBUG', 'ERROR', 'CRITICAL'],
+                        help="Logging level",
+                        default='INFO')
+    args = parser.parse_args()
+    logging.basicConfig(format='%(message)s',
+                        level=getattr(logging, args.log_level))
+
+    server = PhotoServer((args.host, args.port), args.path, connections=args.connections, tmp_db=args.tmp_db,
+                         cache_dir=None if args.no_cache else args.cache_dir)
+    logger.info("Serve %s on http://%s:%s", args.path, *server.server_address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
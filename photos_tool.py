@@ -1,13 +1,27 @@
 __author__ = 'namezys'
 
+import datetime
 import logging
 
-from argparse import ArgumentParser
+from argparse import ArgumentParser, ArgumentTypeError
 
 from library import Library
+from profiler import Profiler, FORMATS, TABLE, phase
+from snapshot import DEFAULT_CACHE_DIR
 
 DESCR = "Read photos database"
 
+DATE_FORMATS = ("%Y-%m-%d", "%Y-%m-%dT%H:%M:%S")
+
+
+def parse_date(value):
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.datetime.strptime(value, date_format)
+        except ValueError:
+            pass
+    raise ArgumentTypeError("%r isn't date like 2014-03-01 or 2014-03-01T12:00:00" % value)
+
 
 def print_photo(photo):
     print "Photo: ", photo.name
@@ -29,13 +43,11 @@ def print_photo(photo):
 
 
 def print_folder(folder, library, offset, deep=None):
-    folders = list(library.fetch_subfolders(folder))
-    albums = list(library.fetch_albums(folder))
-    for f in folders:
+    for f in folder.folders:
         print offset, "folder '%s': uid=%s" % (f.name, f.uuid)
         if deep is None or deep > 1:
             print_folder(f, library, offset + "\t", deep and (deep - 1))
-    for a in albums:
+    for a in folder.albums:
         print offset, "album '%s': uid=%s, poster=%d" % (a.name, a.uuid, a.poster_id)
 
 
@@ -43,6 +55,8 @@ def print_folder(folder, library, offset, deep=None):
 def main():
     parser = ArgumentParser(description=DESCR)
     parser.add_argument("--db-path", "-p", required=True, help="Path to database directory", default=".")
+    parser.add_argument("--cache-dir", default=DEFAULT_CACHE_DIR, help="Directory to keep snapshot of library")
+    parser.add_argument("--no-cache", action="store_true", help="Read databases without snapshot of library")
 
     action_gr = parser.add_argument_group("Actions")
     action_gr.add_argument("--photos", action="store_true", help="List all photos in library")
@@ -50,31 +64,50 @@ def main():
     action_gr.add_argument("--lib-folder", action="store_true", help="List all system library folder")
     action_gr.add_argument("--album", help="List photos in album")
 
+    filter_gr = parser.add_argument_group("Filters of photos")
+    filter_gr.add_argument("--favorite", action="store_true", help="Only favorite photos")
+    filter_gr.add_argument("--date-from", type=parse_date, help="Photos which are taken at this UTC date or later")
+    filter_gr.add_argument("--date-to", type=parse_date, help="Photos which are taken before this UTC date")
+    filter_gr.add_argument("--limit", type=int, help="Maximal number of photos")
+
     parser.add_argument("--log-level",
                         choices=['INFO', 'WARNING', 'DEBUG', 'ERROR', 'CRITICAL'],
                         help="Logging level",
                         default='INFO')
+    parser.add_argument("--profile", nargs="?", const=TABLE, choices=FORMATS,
+                        help="Print statistics of queries and phases at exit")
+    parser.add_argument("--explain", action="store_true", help="Capture query plans for profile")
     args = parser.parse_args()
     logging.basicConfig(format='%(message)s',
                         level=getattr(logging, args.log_level))
 
-    library = Library(args.db_path, True)
+    profiler = Profiler(explain=args.explain) if args.profile else None
+    library = Library(args.db_path, True, profiler=profiler, cache_dir=None if args.no_cache else args.cache_dir)
 
+    filters = dict(favorite=args.favorite or None, date_from=args.date_from, date_to=args.date_to, limit=args.limit)
     if args.photos:
-        for photo in library.fetch_photos():
-            print_photo(photo)
+        with phase(profiler, "photos"):
+            photos = library.query(**filters) if any(v is not None for v in filters.values()) \
+                else library.fetch_photos()
+            for photo in photos:
+                print_photo(photo)
 
     if args.tree:
-        print "Tree:"
-        print_folder(library.top_folder, library, "\t")
+        with phase(profiler, "tree"):
+            print "Tree:"
+            print_folder(library.load_tree()[library.top_folder.uuid], library, "\t")
 
     if args.lib_folder:
-        print_folder(library.library_folder, library, "", 1)
+        with phase(profiler, "lib folder"):
+            print_folder(library.load_tree()[library.library_folder.uuid], library, "", 1)
 
     if args.album:
-        photos = dict((p.id, p) for p in library.fetch_photos())
-        for photo_id in library.fetch_album_photo_id_list(library.album(args.album)):
-            print_photo(photos[photo_id])
+        with phase(profiler, "album"):
+            for photo in library.query(album=args.album, **filters):
+                print_photo(photo)
+
+    if profiler:
+        profiler.dump(args.profile)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,193 @@
+__author__ = 'namezys'
+
+import Queue
+import sys
+import threading
+import time
+
+from logging import getLogger
+
+logger = getLogger(__name__)
+
+QUEUE_SIZE = 4
+BATCH_SIZE = 64
+POLL_INTERVAL = 0.1
+
+_END = object()
+
+
+class Stopped(Exception):
+    """Pipeline is stopped by error of other stage"""
+
+
+class StageStats(object):
+    """Statistics of one stage
+
+    :ivar items: number of processed items
+    :ivar busy: seconds of work of stage
+    :ivar waiting: seconds of waiting for input or for room in output queue
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.items = 0
+        self.busy = 0.0
+        self.waiting = 0.0
+
+    @property
+    def throughput(self):
+        return self.items / self.busy if self.busy else 0.0
+
+    def as_dict(self):
+        return {
+            "items": self.items,
+            "busy": self.busy,
+            "waiting": self.waiting,
+            "throughput": self.throughput,
+        }
+
+
+class Pipeline(object):
+    """Stages which are run by threads and connected by bounded queues
+
+    Source is iterated by its own thread, each transform is run by its own thread
+    and sink is run by calling thread. Items are passed by batches to reduce cost of queues.
+    Stage waits if next stage is behind, so only `queue_size` batches are kept between stages.
+    Error of any stage stops pipeline and it's raised by `run`.
+    """
+
+    def __init__(self, profiler=None, queue_size=QUEUE_SIZE, batch_size=BATCH_SIZE):
+        """
+        :param profiler: `profiler.Profiler` to record statistics of stages
+        """
+        self.profiler = profiler
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.stages = []
+        self.stats = []
+        self.error = None
+        self.stopped = threading.Event()
+
+    def source(self, name, iterable):
+        self.stages.append((name, iterable))
+        return self
+
+    def transform(self, name, func):
+        self.stages.append((name, func))
+        return self
+
+    def run(self, name, sink):
+        """Run all stages and pass results of last one to `sink`"""
+        self.stats = [StageStats(stage_name) for stage_name, _ in self.stages] + [StageStats(name)]
+        start = time.time()
+        queue = Queue.Queue(self.queue_size)
+        threads = [threading.Thread(target=self._run_source, args=(self.stages[0][1], self.stats[0], queue),
+                                    name=self.stages[0][0])]
+        for (stage_name, func), stats in zip(self.stages[1:], self.stats[1:]):
+            output = Queue.Queue(self.queue_size)
+            threads.append(threading.Thread(target=self._run_transform, args=(func, stats, queue, output),
+                                            name=stage_name))
+            queue = output
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        try:
+            self._run_sink(sink, self.stats[-1], queue)
+        except BaseException:
+            self.stopped.set()
+            raise
+        finally:
+            for thread in threads:
+                thread.join()
+        if self.error is not None:
+            raise self.error[0], self.error[1], self.error[2]
+        self._report(time.time() - start)
+
+    def _report(self, elapsed):
+        for stats in self.stats:
+            logger.info("Stage %s: %d items, busy %.3f s (%.0f items/s), waiting %.3f s",
+                        stats.name, stats.items, stats.busy, stats.throughput, stats.waiting)
+            if self.profiler:
+                self.profiler.stage(stats)
+        logger.info("Pipeline is done in %.3f s", elapsed)
+
+    def _fail(self):
+        if self.error is None:
+            self.error = sys.exc_info()
+        self.stopped.set()
+
+    def _put(self, queue, item, stats):
+        start = time.time()
+        while True:
+            try:
+                queue.put(item, timeout=POLL_INTERVAL)
+                break
+            except Queue.Full:
+                if self.stopped.is_set():
+                    raise Stopped()
+        stats.waiting += time.time() - start
+
+    def _get(self, queue, stats):
+        start = time.time()
+        while True:
+            try:
+                item = queue.get(timeout=POLL_INTERVAL)
+                break
+            except Queue.Empty:
+                if self.stopped.is_set():
+                    raise Stopped()
+        stats.waiting += time.time() - start
+        return item
+
+    def _run_source(self, iterable, stats, output):
+        try:
+            iterator = iter(iterable)
+            while True:
+                start = time.time()
+                batch = []
+                for item in iterator:
+                    batch.append(item)
+                    if len(batch) == self.batch_size:
+                        break
+                stats.busy += time.time() - start
+                stats.items += len(batch)
+                if batch:
+                    self._put(output, batch, stats)
+                if len(batch) < self.batch_size:
+                    break
+            self._put(output, _END, stats)
+        except Stopped:
+            pass
+        except BaseException:
+            self._fail()
+
+    def _run_transform(self, func, stats, queue, output):
+        try:
+            while True:
+                batch = self._get(queue, stats)
+                if batch is _END:
+                    break
+                start = time.time()
+                batch = [func(item) for item in batch]
+                stats.busy += time.time() - start
+                stats.items += len(batch)
+                self._put(output, batch, stats)
+            self._put(output, _END, stats)
+        except Stopped:
+            pass
+        except BaseException:
+            self._fail()
+
+    def _run_sink(self, sink, stats, queue):
+        try:
+            while True:
+                batch = self._get(queue, stats)
+                if batch is _END:
+                    break
+                start = time.time()
+                for item in batch:
+                    sink(item)
+                stats.busy += time.time() - start
+                stats.items += len(batch)
+        except Stopped:
+            pass
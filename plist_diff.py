@@ -1,12 +1,23 @@
 __author__ = 'namezys'
 
+import logging
 import plistlib
 import pprint
 
 from argparse import ArgumentParser
+from xml.etree import cElementTree
+
+logger = logging.getLogger(__name__)
 
 DESCR = "Compare 2 plist files"
 
+# lists which are compared as sets of values
+SET_LISTS = {"KeyList"}
+# lists of dicts which are matched by value of key instead of index
+KEYED_LISTS = {"List of Albums": "GUID", "List of Rolls": "RollID"}
+# strings which are shared between values (e.g. photo ids in key lists)
+MAX_INTERNED_STRING = 16
+
 
 class Append(object):
     def __init__(self, v):
@@ -33,6 +44,114 @@ class Replace(object):
         return "%r>%r" % (self.v, self.v1)
 
 
+class SetDiff(object):
+    def __init__(self, added, removed):
+        self.added = added
+        self.removed = removed
+
+    def __repr__(self):
+        return "+%r -%r" % (self.added, self.removed)
+
+
+def _scalar(tag, text):
+    text = text or ""
+    if tag == "string":
+        if len(text) <= MAX_INTERNED_STRING and isinstance(text, str):
+            return intern(text)
+        return text
+    if tag == "integer":
+        return int(text)
+    if tag == "real":
+        return float(text)
+    if tag == "true":
+        return True
+    if tag == "false":
+        return False
+    if tag == "date":
+        return plistlib._dateFromString(text)
+    if tag == "data":
+        return plistlib.Data.fromBase64(text)
+    raise ValueError("Unknown plist element %s" % tag)
+
+
+class UnsortedPlist(Exception):
+    pass
+
+
+class MixedPlist(Exception):
+    """Value is dict in one plist and it isn't dict in another one"""
+    pass
+
+
+def iter_plist(path_or_file, depth=0):
+    """Read xml plist by iterparse and yield its values
+
+    Dicts above `depth` aren't kept, their values are yielded one by one as (path of keys, value).
+    Empty dict above `depth` (except root one) is yielded as value, so it's compared too.
+    Elements are dropped as soon as they are parsed, so only yielded values are kept in memory.
+    """
+    elements = []
+    frames = []
+    for event, element in cElementTree.iterparse(path_or_file, events=("start", "end")):
+        if event == "start":
+            elements.append(element)
+            if element.tag == "dict":
+                streamed = len(frames) < depth and (not frames or frames[-1][0] is None)
+                frames.append([None if streamed else dict(), None, False])
+            elif element.tag == "array":
+                frames.append([[], None, False])
+            continue
+        elements.pop()
+        if elements:
+            elements[-1].remove(element)
+        tag = element.tag
+        if tag == "plist":
+            continue
+        if tag == "key":
+            frames[-1][1] = element.text or ""
+            continue
+        if tag in ("dict", "array"):
+            value, _, has_items = frames.pop()
+            if value is None:
+                if has_items or not frames:
+                    continue
+                value = dict()
+        else:
+            value = _scalar(tag, element.text)
+        if not frames:
+            yield (), value
+        elif frames[-1][0] is None:
+            frames[-1][2] = True
+            yield tuple(f[1] for f in frames), value
+        elif isinstance(frames[-1][0], dict):
+            frames[-1][0][frames[-1][1]] = value
+        else:
+            frames[-1][0].append(value)
+
+
+def read_plist(path_or_file):
+    """Read xml plist by iterparse without keeping of document tree"""
+    for _, value in iter_plist(path_or_file):
+        return value
+
+
+def _sorted(items):
+    previous = None
+    for path, value in items:
+        if previous is not None and path <= previous:
+            raise UnsortedPlist("%r is after %r" % (path, previous))
+        previous = path
+        yield path, value
+
+
+def _set_path(res, path, value):
+    for k in path[:-1]:
+        res = res.setdefault(k, {})
+        if not isinstance(res, dict):
+            raise MixedPlist("%r isn't dict in both files" % (path[:-1],))
+    res[path[-1]] = value
+
+
 def diff_non_dict(v1, v2):
     if v1 == v2:
         return None
@@ -43,23 +162,42 @@ def diff_non_dict(v1, v2):
     return Replace(v1, v2)
 
 
-def diff_list(l1, l2):
-    if len(l1) != len(l2):
-        return Replace(l1, l2)
+def diff_set(l1, l2):
+    s1 = set(l1)
+    s2 = set(l2)
+    if s1 == s2:
+        return None
+    return SetDiff(sorted(s2 - s1), sorted(s1 - s2))
+
+
+def diff_keyed_list(l1, l2, key):
+    """Match dicts of lists by value of key"""
+    d1 = dict((v.get(key), v) for v in l1)
+    d2 = dict((v.get(key), v) for v in l2)
+    return diff_value(d1, d2)
+
+
+def diff_list(l1, l2, key=None):
+    if key in SET_LISTS:
+        return diff_set(l1, l2)
+    if key in KEYED_LISTS and all(isinstance(v, dict) for v in l1 + l2):
+        return diff_keyed_list(l1, l2, KEYED_LISTS[key])
     res = []
-    for i in range(len(l1)):
+    for i in range(min(len(l1), len(l2))):
         t1 = l1[i]
         t2 = l2[i]
         r = diff_value(t1, t2)
         res.append(r)
+    res += [Remove(v) for v in l1[len(l2):]]
+    res += [Append(v) for v in l2[len(l1):]]
     if any(l for l in res):
         return res
     return None
 
 
-def diff_value(v1, v2):
+def diff_value(v1, v2, key=None):
     if isinstance(v1, list) and isinstance(v2, list):
-        return diff_list(v1, v2)
+        return diff_list(v1, v2, key)
     if not isinstance(v1, dict) or not isinstance(v2, dict):
         return diff_non_dict(v1, v2)
     keys = set(v1) | set(v2)
@@ -67,18 +205,58 @@ def diff_value(v1, v2):
     for k in keys:
         t1 = v1.get(k, None)
         t2 = v2.get(k, None)
-        r = diff_value(t1, t2)
+        r = diff_value(t1, t2, k)
         if r is not None:
             res[k] = r
     return res or None
 
 
+def diff_files(file_a, file_b):
+    """Compare 2 xml plist files
+
+    Entries of dicts of top level (e.g. images of "Master Image List") are read and compared one by one,
+    if keys are sorted like `plistlib` writes them and types of values of top level match.
+    Otherwise both files are read at once.
+    """
+    try:
+        return _diff_sorted_items(_sorted(iter_plist(file_a, 2)), _sorted(iter_plist(file_b, 2)))
+    except UnsortedPlist as e:
+        logger.info("Keys aren't sorted (%s), read whole files", e)
+    except MixedPlist as e:
+        logger.info("Types of values differ (%s), read whole files", e)
+    return diff_value(read_plist(file_a), read_plist(file_b))
+
+
+def _diff_sorted_items(items_a, items_b):
+    res = {}
+    a = next(items_a, None)
+    b = next(items_b, None)
+    while a is not None or b is not None:
+        if b is None or a is not None and a[0] < b[0]:
+            _set_path(res, a[0], Remove(a[1]))
+            a = next(items_a, None)
+        elif a is None or b[0] < a[0]:
+            _set_path(res, b[0], Append(b[1]))
+            b = next(items_b, None)
+        else:
+            r = diff_value(a[1], b[1], a[0][-1] if a[0] else None)
+            if r is not None:
+                if not a[0]:
+                    return r
+                _set_path(res, a[0], r)
+            a = next(items_a, None)
+            b = next(items_b, None)
+    return res or None
+
+
 def test():
     a = {"a": "a", "b": "b", "d": 1}
     b = {"a": "a", "c": "c", "d": "2"}
 
-    v1 = {"a": {"a": a}, "b": "bb", "c": 1, "d": [1, 2, 3]}
-    v2 = {"a": {"a": b}, "b": "cc", "c": 1, "d": [1, 2]}
+    v1 = {"a": {"a": a}, "b": "bb", "c": 1, "d": [1, 2, 3], "KeyList": ["1", "2", "3"],
+          "List of Albums": [{"GUID": "x", "v": 1}, {"GUID": "y"}]}
+    v2 = {"a": {"a": b}, "b": "cc", "c": 1, "d": [1, 2], "KeyList": ["1", "3", "4"],
+          "List of Albums": [{"GUID": "y"}, {"GUID": "x", "v": 2}]}
     r = diff_value(v1, v2)
     pprint.pprint(r)
 
@@ -90,10 +268,7 @@ def main():
 
     args = parser.parse_args()
 
-    a = plistlib.readPlist(args.file_a)
-    b = plistlib.readPlist(args.file_b)
-
-    r = diff_value(a, b)
+    r = diff_files(args.file_a, args.file_b)
     pprint.pprint(r)
 
 
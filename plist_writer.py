@@ -0,0 +1,162 @@
+__author__ = 'namezys'
+
+import array
+import plistlib
+import struct
+
+
+class XmlPlistWriter(plistlib.PlistWriter):
+    """Write xml plist by parts
+
+    Output is the same as `plistlib.writePlist` gives if keys of every dict are written in sorted order.
+    """
+
+    def __init__(self, file):
+        plistlib.PlistWriter.__init__(self, file)
+        self.writeln("<plist version=\"1.0\">")
+
+    def begin_dict(self, key=None):
+        if key is not None:
+            self.simpleElement("key", key)
+        self.beginElement("dict")
+
+    def end_dict(self):
+        self.endElement("dict")
+
+    def write_item(self, key, value):
+        self.simpleElement("key", key)
+        self.writeValue(value)
+
+    def close(self):
+        self.writeln("</plist>")
+
+
+class BinaryPlistWriter(object):
+    """Write binary plist (bplist00) by parts
+
+    Objects are written as soon as they are complete, so only references of open dicts are kept in memory.
+    Keys, short strings and integers are written once and shared by reference
+    (e.g. photo ids in every `KeyList`).
+    """
+
+    REF_SIZE = 4  # size of ">L"
+    MAX_SHARED_STRING = 16
+
+    def __init__(self, file):
+        self.file = file
+        self.position = 0
+        self.offsets = array.array('L')
+        self.shared = dict()
+        self.stack = []
+        self.top = None
+        self._write("bplist00")
+
+    def begin_dict(self, key=None):
+        self.stack.append((key, array.array('L'), array.array('L')))
+
+    def end_dict(self):
+        key, keys, values = self.stack.pop()
+        ref = self._object(_marker(0xD0, len(keys)) + self._refs(keys) + self._refs(values))
+        if self.stack:
+            self._append(key, ref)
+        else:
+            self.top = ref
+
+    def write_item(self, key, value):
+        self._append(key, self._value(value))
+
+    def close(self):
+        offset_table = self.position
+        offset_size = _int_size(offset_table)
+        self._write("".join(_pack_uint(offset, offset_size) for offset in self.offsets))
+        self._write(struct.pack(">6xBBQQQ", offset_size, self.REF_SIZE, len(self.offsets), self.top, offset_table))
+
+    def _append(self, key, ref):
+        _, keys, values = self.stack[-1]
+        keys.append(self._value(key, shared=True))
+        values.append(ref)
+
+    def _write(self, data):
+        self.file.write(data)
+        self.position += len(data)
+
+    def _object(self, data):
+        self.offsets.append(self.position)
+        self._write(data)
+        return len(self.offsets) - 1
+
+    def _refs(self, refs):
+        return struct.pack(">%dL" % len(refs), *refs)
+
+    def _value(self, value, shared=False):
+        if isinstance(value, str):
+            value = value.decode("utf-8")
+        shared_key = None
+        if shared or isinstance(value, (int, long)) or \
+                isinstance(value, unicode) and len(value) <= self.MAX_SHARED_STRING:
+            shared_key = (type(value), value)
+            ref = self.shared.get(shared_key)
+            if ref is not None:
+                return ref
+        ref = self._object(self._encode(value))
+        if shared_key is not None:
+            self.shared[shared_key] = ref
+        return ref
+
+    def _encode(self, value):
+        if isinstance(value, bool):
+            return "\x09" if value else "\x08"
+        if isinstance(value, (int, long)):
+            return _encode_int(value)
+        if isinstance(value, float):
+            return "\x23" + struct.pack(">d", value)
+        if isinstance(value, unicode):
+            try:
+                return _marker(0x50, len(value)) + value.encode("ascii")
+            except UnicodeEncodeError:
+                data = value.encode("utf-16be")
+                return _marker(0x60, len(data) // 2) + data
+        if isinstance(value, dict):
+            items = sorted(value.items())
+            keys = [self._value(k, shared=True) for k, _ in items]
+            values = [self._value(v) for _, v in items]
+            return _marker(0xD0, len(items)) + self._refs(keys) + self._refs(values)
+        if isinstance(value, (tuple, list)):
+            refs = [self._value(v) for v in value]
+            return _marker(0xA0, len(refs)) + self._refs(refs)
+        raise TypeError("unsupported type: %s" % type(value))
+
+
+def _marker(marker, length):
+    if length < 15:
+        return chr(marker | length)
+    return chr(marker | 0xF) + _encode_int(length)
+
+
+def _int_size(value):
+    for size in (1, 2, 4):
+        if value < 1 << (8 * size):
+            return size
+    return 8
+
+
+def _pack_uint(value, size):
+    return struct.pack(_UINT_FORMATS[size], value)
+
+
+def _encode_int(value):
+    if value < 0:
+        return "\x13" + struct.pack(">q", value)
+    size = _int_size(value)
+    return chr(0x10 | {1: 0, 2: 1, 4: 2, 8: 3}[size]) + _pack_uint(value, size)
+
+
+_UINT_FORMATS = {1: ">B", 2: ">H", 4: ">L", 8: ">Q"}
+
+
+XML = "xml"
+BINARY = "binary"
+WRITERS = {
+    XML: XmlPlistWriter,
+    BINARY: BinaryPlistWriter,
+}
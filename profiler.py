@@ -0,0 +1,198 @@
+__author__ = 'namezys'
+
+import collections
+import contextlib
+import json
+import sys
+import time
+
+from logging import getLogger
+
+logger = getLogger(__name__)
+
+TABLE = "table"
+JSON = "json"
+FORMATS = (TABLE, JSON)
+
+
+def _percentile(values, percent):
+    """Percentile of sorted values or None if there are no values"""
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * percent / 100.0))]
+
+
+def _seconds(value):
+    return "%9s" % "-" if value is None else "%9.4f" % value
+
+
+class QueryStats(object):
+    """Statistics of one query shape
+
+    :ivar latencies: time of execution and fetching of every query (query which isn't fetched isn't counted)
+    :ivar rows: number of fetched rows
+    :ivar plan: list of details of query plan
+    """
+
+    def __init__(self, shape):
+        self.shape = shape
+        self.latencies = []
+        self.rows = 0
+        self.plan = None
+
+    def as_dict(self):
+        latencies = sorted(self.latencies)
+        return {
+            "query": self.shape,
+            "count": len(latencies),
+            "total": sum(latencies),
+            "p50": _percentile(latencies, 50),
+            "p90": _percentile(latencies, 90),
+            "p99": _percentile(latencies, 99),
+            "rows": self.rows,
+            "plan": self.plan,
+        }
+
+
+class ProfiledCursor(object):
+    """Cursor which counts fetched rows and time of fetching"""
+
+    def __init__(self, cursor, stats, elapsed):
+        self.cursor = cursor
+        self.stats = stats
+        self.elapsed = elapsed
+        self.rows = 0
+        self.done = False
+
+    def _finish(self):
+        if not self.done:
+            self.done = True
+            self.stats.latencies.append(self.elapsed)
+            self.stats.rows += self.rows
+
+    def __iter__(self):
+        try:
+            while True:
+                start = time.time()
+                row = self.cursor.fetchone()
+                self.elapsed += time.time() - start
+                if row is None:
+                    break
+                self.rows += 1
+                yield row
+        finally:
+            self._finish()
+
+    def fetchone(self):
+        start = time.time()
+        row = self.cursor.fetchone()
+        self.elapsed += time.time() - start
+        self.rows += row is not None
+        self._finish()
+        return row
+
+    def fetchall(self):
+        start = time.time()
+        rows = self.cursor.fetchall()
+        self.elapsed += time.time() - start
+        self.rows += len(rows)
+        self._finish()
+        return rows
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+
+class ProfiledConnection(object):
+    """Connection which records statistics of queries to profiler"""
+
+    def __init__(self, db, profiler):
+        self.db = db
+        self.profiler = profiler
+
+    def execute(self, sql, parameters=()):
+        stats = self.profiler.query_stats(sql)
+        if self.profiler.explain and stats.plan is None:
+            stats.plan = [row[-1] for row in self.db.execute("EXPLAIN QUERY PLAN " + sql, parameters)]
+        start = time.time()
+        try:
+            cursor = self.db.execute(sql, parameters)
+        except Exception:
+            stats.latencies.append(time.time() - start)
+            raise
+        return ProfiledCursor(cursor, stats, time.time() - start)
+
+    def __getattr__(self, name):
+        return getattr(self.db, name)
+
+
+class Profiler(object):
+    """Statistics of queries by shape, wall time of phases and statistics of pipeline stages
+
+    :ivar explain: capture `EXPLAIN QUERY PLAN` of each query shape
+    """
+
+    def __init__(self, explain=False):
+        self.explain = explain
+        self.queries = collections.OrderedDict()
+        self.phases = collections.OrderedDict()
+        self.stages = collections.OrderedDict()
+
+    def connection(self, db):
+        return ProfiledConnection(db, self)
+
+    def query_stats(self, sql):
+        shape = " ".join(sql.split())
+        stats = self.queries.get(shape)
+        if stats is None:
+            stats = self.queries[shape] = QueryStats(shape)
+        return stats
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0) + time.time() - start
+
+    def stage(self, stats):
+        """Record statistics of stage of `pipeline.Pipeline`"""
+        self.stages[stats.name] = stats.as_dict()
+
+    def as_dict(self):
+        return {
+            "queries": [stats.as_dict() for stats in self.queries.values()],
+            "phases": self.phases,
+            "stages": self.stages,
+        }
+
+    def dump(self, output_format=TABLE, stream=None):
+        stream = stream or sys.stderr
+        data = self.as_dict()
+        if output_format == JSON:
+            json.dump(data, stream, indent=2)
+            stream.write("\n")
+            return
+        stream.write("%6s %9s %9s %9s %9s %9s  %s\n" % ("count", "total", "p50", "p90", "p99", "rows", "query"))
+        for q in sorted(data["queries"], key=lambda q: -q["total"]):
+            stream.write("%6d %9.4f %s %s %s %9d  %s\n" % (q["count"], q["total"], _seconds(q["p50"]),
+                                                        _seconds(q["p90"]), _seconds(q["p99"]), q["rows"],
+                                                        q["query"][:120]))
+            for detail in q["plan"] or []:
+                stream.write("%57s%s\n" % ("", detail))
+        for name, elapsed in data["phases"].items():
+            stream.write("phase %-20s %9.4f\n" % (name, elapsed))
+        for name, stage in data["stages"].items():
+            stream.write("stage %-20s %9.4f %9d items %9.0f items/s %9.4f waiting\n" % (
+                name, stage["busy"], stage["items"], stage["throughput"], stage["waiting"]))
+
+
+@contextlib.contextmanager
+def phase(profiler, name):
+    """Phase of profiler if it's given"""
+    if profiler is None:
+        yield
+        return
+    with profiler.phase(name):
+        yield
@@ -0,0 +1,123 @@
+__author__ = 'namezys'
+
+import hashlib
+import multiprocessing
+import os
+
+from logging import getLogger
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+logger = getLogger(__name__)
+
+DEFAULT_QUALITY = 85
+JPEG_EXT = ".jpg"
+
+NO_PIL = "PIL is required to resize images"
+
+
+def cache_path(cache_dir, src, max_size, quality):
+    """Path of resized image in cache
+
+    Key is path, modification time and size of source and parameters of resizing.
+    """
+    stat = os.stat(src)
+    key = "%s\0%r\0%d\0%d\0%d" % (os.path.realpath(src), stat.st_mtime, stat.st_size, max_size, quality)
+    digest = hashlib.md5(key).hexdigest()
+    return os.path.join(cache_dir, digest[:2], digest + JPEG_EXT)
+
+
+def resize(src, dst, max_size, quality):
+    """Write JPEG which fits in square with side `max_size`
+
+    JPEG is decoded with reduced scale if it's possible.
+    """
+    image = Image.open(src)
+    image.draft("RGB", (max_size, max_size))
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    image.thumbnail((max_size, max_size), Image.ANTIALIAS)
+    tmp_dst = "%s.%d.tmp" % (dst, os.getpid())
+    try:
+        image.save(tmp_dst, "JPEG", quality=quality, optimize=True)
+    except IOError:
+        if os.path.exists(tmp_dst):
+            os.remove(tmp_dst)
+        raise
+    os.rename(tmp_dst, dst)
+
+
+def _cached_resize(args):
+    """Resize image to cache
+
+    :return: path of resized image, flag of resize and error, source is returned as is if PIL can't read it
+    """
+    src, cache_dir, max_size, quality = args
+    path = cache_path(cache_dir, src, max_size, quality)
+    if os.path.exists(path):
+        return path, False, None
+    directory = os.path.dirname(path)
+    if not os.path.exists(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            if not os.path.isdir(directory):
+                raise
+    try:
+        resize(src, path, max_size, quality)
+    except IOError as e:
+        return src, False, str(e)
+    return path, True, None
+
+
+class Resizer(object):
+    """Resize images by pool of processes and keep results in cache directory
+
+    :ivar resized: number of resized images
+    :ivar cached: number of images which are got from cache
+    :ivar failed: number of images which can't be read and are kept as is
+    """
+
+    def __init__(self, max_size, cache_dir, quality=DEFAULT_QUALITY, processes=None):
+        """
+        :param processes: number of processes (default is number of CPUs)
+        :raise RuntimeError: if PIL isn't installed
+        """
+        if Image is None:
+            raise RuntimeError(NO_PIL)
+        self.max_size = max_size
+        self.quality = quality
+        self.cache_dir = cache_dir
+        self.pool = multiprocessing.Pool(processes)
+        self.resized = 0
+        self.cached = 0
+        self.failed = 0
+
+    def resize(self, sources):
+        """Resize images
+
+        Image which can't be read by PIL (like RAW or HEIC) isn't resized and its source is returned.
+
+        :return: list of paths of resized images in cache
+        """
+        paths = []
+        for path, resized, error in self.pool.map(_cached_resize, [(src, self.cache_dir, self.max_size, self.quality)
+                                                                   for src in sources]):
+            paths.append(path)
+            if error:
+                logger.warning("Can't resize %s: %s", path, error)
+                self.failed += 1
+            elif resized:
+                self.resized += 1
+            else:
+                self.cached += 1
+        return paths
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        logger.info("Resized %s, got from cache %s, failed to resize %s images",
+                    self.resized, self.cached, self.failed)
@@ -0,0 +1,151 @@
+__author__ = 'namezys'
+
+import array
+import cPickle
+import hashlib
+import mmap
+import os
+import struct
+import tempfile
+
+from logging import getLogger
+
+logger = getLogger(__name__)
+
+MAGIC = "MPSNAP01"
+PREFIX = struct.Struct("<8sQ")
+ALIGN = 8
+PICKLE = "pickle"
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "mac_photos")
+
+# Files modified so close to creation of snapshot can be changed after it without change of size and mtime
+RACY_SECONDS = 2
+
+
+def snapshot_path(cache_dir, db_path):
+    """Path of snapshot of library in cache directory"""
+    name = hashlib.md5(os.path.realpath(db_path)).hexdigest()
+    return os.path.join(cache_dir, name + ".snapshot")
+
+
+def database_stamp(db_path, names):
+    """Size and modification time of database files and their write-ahead logs"""
+    stamp = []
+    for name in names:
+        for path in (os.path.join(db_path, name), os.path.join(db_path, name) + "-wal"):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                stamp.append(None)
+            else:
+                stamp.append((stat.st_size, stat.st_mtime))
+    return stamp
+
+
+def write_snapshot(path, key, sections):
+    """Write snapshot atomically
+
+    :param key: key of databases which snapshot is made from
+    :param sections: dict of name to array or to any picklable value
+    """
+    blobs = []
+    index = dict()
+    offset = 0
+    for name, value in sections.iteritems():
+        if isinstance(value, array.array):
+            blob = value.tostring()
+            kind = value.typecode
+        else:
+            blob = cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL)
+            kind = PICKLE
+        padding = -len(blob) % ALIGN
+        index[name] = (offset, len(blob), kind)
+        blobs.append(blob)
+        blobs.append("\0" * padding)
+        offset += len(blob) + padding
+    header = cPickle.dumps({"key": key, "size": offset, "sections": index}, cPickle.HIGHEST_PROTOCOL)
+    header += "\0" * (-len(header) % ALIGN)
+    directory = os.path.dirname(path)
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    # snapshot can be written by several libraries of process at once
+    fd, tmp_path = tempfile.mkstemp(".tmp", os.path.basename(path) + ".", directory)
+    try:
+        with os.fdopen(fd, "wb") as snapshot_file:
+            snapshot_file.write(PREFIX.pack(MAGIC, len(header)))
+            snapshot_file.write(header)
+            for blob in blobs:
+                snapshot_file.write(blob)
+        os.rename(tmp_path, path)
+    except EnvironmentError:
+        os.remove(tmp_path)
+        raise
+    logger.info("Write snapshot %s (%d bytes)", path, PREFIX.size + len(header) + offset)
+
+
+class Snapshot(object):
+    """Snapshot of library which is mapped to memory
+
+    Arrays are stored as raw data and other sections are pickled.
+    Section is decoded on first access, so only used sections are read.
+
+    :ivar key: key of databases which snapshot is made from
+    :ivar mtime: modification time of snapshot file
+    """
+
+    def __init__(self, data, base, key, index, mtime):
+        self.data = data
+        self.base = base
+        self.key = key
+        self.index = index
+        self.mtime = mtime
+        self.sections = dict()
+
+    @classmethod
+    def open(cls, path):
+        """Map snapshot to memory
+
+        :return: snapshot or None if it's absent or unusable
+        """
+        try:
+            with open(path, "rb") as snapshot_file:
+                mtime = os.fstat(snapshot_file.fileno()).st_mtime
+                data = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (EnvironmentError, ValueError) as e:
+            logger.debug("Can't open snapshot %s: %s", path, e)
+            return None
+        if len(data) < PREFIX.size:
+            return None
+        magic, header_length = PREFIX.unpack_from(data)
+        if magic != MAGIC:
+            logger.info("Unknown format of snapshot %s", path)
+            return None
+        try:
+            header = cPickle.loads(data[PREFIX.size:PREFIX.size + header_length])
+        except (cPickle.UnpicklingError, EOFError, ValueError) as e:
+            logger.warning("Can't read snapshot %s: %s", path, e)
+            return None
+        base = PREFIX.size + header_length
+        if len(data) != base + header["size"]:
+            logger.warning("Snapshot %s is truncated", path)
+            return None
+        return cls(data, base, header["key"], header["sections"], mtime)
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def __getitem__(self, name):
+        try:
+            return self.sections[name]
+        except KeyError:
+            pass
+        offset, length, kind = self.index[name]
+        start = self.base + offset
+        if kind == PICKLE:
+            value = cPickle.loads(self.data[start:start + length])
+        else:
+            value = array.array(kind)
+            value.fromstring(buffer(self.data, start, length))
+        self.sections[name] = value
+        return value
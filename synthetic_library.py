@@ -0,0 +1,199 @@
+__author__ = 'namezys'
+
+import logging
+import os
+import random
+import sqlite3
+import uuid as uuid_module
+
+from argparse import ArgumentParser
+
+logger = logging.getLogger(__name__)
+
+DESCR = "Create synthetic photos library"
+
+LIBRARY_SCHEMA = """
+CREATE TABLE RKVersion (modelId INTEGER PRIMARY KEY, uuid VARCHAR, name VARCHAR, masterUuid VARCHAR,
+    imageDate TIMESTAMP, lastModifiedDate TIMESTAMP, imageTimeZoneName VARCHAR,
+    imageTimeZoneOffsetSeconds INTEGER, extendedDescription VARCHAR, isFavorite INTEGER,
+    adjustmentUuid VARCHAR, isInTrash INTEGER, type INTEGER);
+CREATE INDEX RKVersion_uuid_index ON RKVersion(uuid);
+CREATE TABLE RKMaster (modelId INTEGER PRIMARY KEY, uuid VARCHAR, imagePath VARCHAR);
+CREATE INDEX RKMaster_uuid_index ON RKMaster(uuid);
+CREATE TABLE RKFolder (modelId INTEGER PRIMARY KEY, uuid VARCHAR, name VARCHAR, parentFolderUuid VARCHAR,
+    implicitAlbumUuid VARCHAR, isInTrash INTEGER);
+CREATE INDEX RKFolder_uuid_index ON RKFolder(uuid);
+CREATE INDEX RKFolder_parentFolderUuid_index ON RKFolder(parentFolderUuid);
+CREATE TABLE RKAlbum (modelId INTEGER PRIMARY KEY, uuid VARCHAR, name VARCHAR, folderUuid VARCHAR,
+    posterVersionUuid VARCHAR, isInTrash INTEGER);
+CREATE INDEX RKAlbum_uuid_index ON RKAlbum(uuid);
+CREATE INDEX RKAlbum_folderUuid_index ON RKAlbum(folderUuid);
+CREATE TABLE RKAlbumVersion (modelId INTEGER PRIMARY KEY, versionId INTEGER, albumId INTEGER);
+CREATE INDEX RKAlbumVersion_albumId_index ON RKAlbumVersion(albumId);
+CREATE INDEX RKAlbumVersion_versionId_index ON RKAlbumVersion(versionId);
+"""
+
+IMAGE_PROXIES_SCHEMA = """
+CREATE TABLE RKModelResource (modelId INTEGER PRIMARY KEY, resourceTag VARCHAR, resourceUuid VARCHAR,
+    filename VARCHAR);
+CREATE INDEX RKModelResource_resourceTag_index ON RKModelResource(resourceTag);
+"""
+
+TIME_ZONES = ["Europe/Moscow", "America/New_York", "Asia/Tokyo", "Europe/London", "GMT"]
+DATE_FROM = 378691200  # 2013-01-01 in seconds since 2001-01-01
+
+DEPTH = 3
+FANOUT = 3
+
+
+def _uuid():
+    return uuid_module.uuid4().hex[:22]
+
+
+def _touch(path, size):
+    directory = os.path.dirname(path)
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    with open(path, "wb") as f:
+        f.write("\xff\xd8" + "\0" * max(0, size - 4) + "\xff\xd9")
+
+
+class SyntheticLibrary(object):
+    """Generator of minimal Photos library
+
+    :ivar path: path of library (it contains `database`, `Masters`, `Thumbnails`)
+    """
+
+    def __init__(self, path, photos=1000, adjusted=0.2, favorite=0.05, depth=DEPTH, fanout=FANOUT,
+                 albums_per_folder=2, album_size=50, file_size=1024, seed=0):
+        self.path = path
+        self.photos = photos
+        self.adjusted = adjusted
+        self.favorite = favorite
+        self.depth = depth
+        self.fanout = fanout
+        self.albums_per_folder = albums_per_folder
+        self.album_size = album_size
+        self.file_size = file_size
+        self.random = random.Random(seed)
+        self.version_uuids = []
+        self.folder_id = 0
+        self.album_id = 0
+
+    def create(self):
+        db_path = os.path.join(self.path, "database")
+        if not os.path.exists(db_path):
+            os.makedirs(db_path)
+        library_db = sqlite3.connect(os.path.join(db_path, "Library.apdb"))
+        image_proxies_db = sqlite3.connect(os.path.join(db_path, "ImageProxies.apdb"))
+        library_db.executescript(LIBRARY_SCHEMA)
+        image_proxies_db.executescript(IMAGE_PROXIES_SCHEMA)
+        logger.info("Create %s photos", self.photos)
+        self._create_photos(library_db, image_proxies_db)
+        logger.info("Create folders and albums")
+        self._create_system(library_db)
+        self._create_folder(library_db, "TopLevelAlbums", 0)
+        library_db.commit()
+        image_proxies_db.commit()
+        library_db.close()
+        image_proxies_db.close()
+
+    def _create_photos(self, library_db, image_proxies_db):
+        rnd = self.random
+        for version_id in range(1, self.photos + 1):
+            version_uuid = _uuid()
+            master_uuid = _uuid()
+            date = DATE_FROM + rnd.randint(0, 3 * 365 * 24 * 3600) + rnd.randint(0, 999) / 1000.0
+            image_dir = "%d/%02d/%02d/%d" % (2013 + version_id % 3, version_id % 12 + 1, version_id % 28 + 1,
+                                             version_id // 100)
+            name = "IMG_%04d" % version_id
+            image_path = "%s/%s.jpg" % (image_dir, name)
+            adjustment = "UNADJUSTEDNONRAW"
+            if rnd.random() < self.adjusted:
+                adjustment = _uuid()
+                resource_uuid = _uuid()
+                filename = "fullsizeoutput_%x.jpeg" % version_id
+                image_proxies_db.execute("INSERT INTO RKModelResource (resourceTag, resourceUuid, filename)"
+                                         " VALUES (?, ?, ?)", [adjustment, resource_uuid, filename])
+                _touch(os.path.join(self.path, "resources/modelresources", str(ord(resource_uuid[0])),
+                                    str(ord(resource_uuid[1])), resource_uuid, filename), self.file_size)
+            zone = rnd.choice(TIME_ZONES)
+            library_db.execute("INSERT INTO RKMaster (uuid, imagePath) VALUES (?, ?)", [master_uuid, image_path])
+            library_db.execute("""INSERT INTO RKVersion (modelId, uuid, name, masterUuid, imageDate, lastModifiedDate,
+                                      imageTimeZoneName, imageTimeZoneOffsetSeconds, extendedDescription,
+                                      isFavorite, adjustmentUuid, isInTrash, type)
+                                  VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 0, 2)""",
+                               [version_id, version_uuid, rnd.choice([name, None]), master_uuid, date,
+                                date + rnd.randint(0, 3600) + 0.5, zone, 3600 * rnd.randint(-8, 9) if zone else 0,
+                                rnd.choice(["", None, "description %d" % version_id]),
+                                int(rnd.random() < self.favorite), adjustment])
+            self.version_uuids.append(version_uuid)
+            _touch(os.path.join(self.path, "Masters", image_path), self.file_size)
+            thumbnails = os.path.join(self.path, "Thumbnails", image_dir, version_uuid)
+            _touch(os.path.join(thumbnails, "thumb_%s.jpg" % name), self.file_size // 8)
+            _touch(os.path.join(thumbnails, "%s_1024.jpg" % name), self.file_size // 2)
+
+    def _insert_album(self, library_db, uuid, name, folder_uuid, version_ids, in_trash=False):
+        poster = self.version_uuids[version_ids[0] - 1] if version_ids else None
+        cursor = library_db.execute("INSERT INTO RKAlbum (uuid, name, folderUuid, posterVersionUuid, isInTrash)"
+                                    " VALUES (?, ?, ?, ?, ?)", [uuid, name, folder_uuid, poster, int(in_trash)])
+        library_db.executemany("INSERT INTO RKAlbumVersion (albumId, versionId) VALUES (?, ?)",
+                               [(cursor.lastrowid, version_id) for version_id in version_ids])
+
+    def _insert_folder(self, library_db, uuid, name, parent_uuid, in_trash=False):
+        implicit_uuid = _uuid()
+        library_db.execute("INSERT INTO RKFolder (uuid, name, parentFolderUuid, implicitAlbumUuid, isInTrash)"
+                           " VALUES (?, ?, ?, ?, ?)", [uuid, name, parent_uuid, implicit_uuid, int(in_trash)])
+        self._insert_album(library_db, implicit_uuid, None, uuid, [])
+
+    def _create_system(self, library_db):
+        all_ids = list(range(1, self.photos + 1))
+        self._insert_folder(library_db, "TopLevelAlbums", None, None)
+        self._insert_folder(library_db, "LibraryFolder", "Library", None)
+        self._insert_album(library_db, "allPhotosAlbum", "Photos", "LibraryFolder", all_ids)
+        self._insert_album(library_db, "lastImportAlbum", "Last Import", "LibraryFolder", all_ids[-10:])
+        self._insert_album(library_db, "favoritesAlbum", "Favorites", "LibraryFolder", [])
+
+    def _create_folder(self, library_db, folder_uuid, level):
+        rnd = self.random
+        for i in range(self.albums_per_folder):
+            self.album_id += 1
+            size = min(self.photos, rnd.randint(1, 2 * self.album_size))
+            version_ids = sorted(rnd.sample(range(1, self.photos + 1), size))
+            self._insert_album(library_db, _uuid(), "Album %d" % self.album_id, folder_uuid, version_ids)
+        if level >= self.depth:
+            return
+        for i in range(self.fanout):
+            self.folder_id += 1
+            uuid = _uuid()
+            self._insert_folder(library_db, uuid, "Folder %d" % self.folder_id, folder_uuid)
+            self._create_folder(library_db, uuid, level + 1)
+
+
+def main():
+    parser = ArgumentParser(description=DESCR)
+    parser.add_argument("--photos", type=int, default=1000, help="Number of photos")
+    parser.add_argument("--adjusted", type=float, default=0.2, help="Ratio of adjusted photos")
+    parser.add_argument("--depth", type=int, default=DEPTH, help="Depth of folder tree")
+    parser.add_argument("--fanout", type=int, default=FANOUT, help="Subfolders in each folder")
+    parser.add_argument("--albums", type=int, default=2, help="Albums in each folder")
+    parser.add_argument("--album-size", type=int, default=50, help="Average album size")
+    parser.add_argument("--file-size", type=int, default=1024, help="Size of dummy photo files")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+    parser.add_argument("--log-level",
+                        choices=['INFO', 'WARNING', 'DEBUG', 'ERROR', 'CRITICAL'],
+                        help="Logging level",
+                        default='INFO')
+    parser.add_argument("path", help="Path to create library")
+
+    args = parser.parse_args()
+    logging.basicConfig(format='%(message)s',
+                        level=getattr(logging, args.log_level))
+
+    SyntheticLibrary(args.path, photos=args.photos, adjusted=args.adjusted, depth=args.depth, fanout=args.fanout,
+                     albums_per_folder=args.albums, album_size=args.album_size, file_size=args.file_size,
+                     seed=args.seed).create()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+__author__ = 'namezys'
+
+import json
+import os
+import time
+
+from logging import getLogger
+
+from snapshot import database_stamp
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+logger = getLogger(__name__)
+
+POLL_INTERVAL = 1.0
+DEBOUNCE = 2.0
+
+
+class Watcher(object):
+    """Wait for change of database files and their write-ahead logs
+
+    Changes are got by inotify if pyinotify is installed, otherwise files are polled.
+    Size and modification time of files are compared in both cases, so other events in directory are ignored.
+    """
+
+    def __init__(self, db_path, names, poll_interval=POLL_INTERVAL, debounce=DEBOUNCE):
+        """
+        :param db_path: database directory
+        :param names: names of database files
+        :param poll_interval: seconds between checks of files if inotify isn't used
+        :param debounce: seconds without changes which are waited after change
+        """
+        self.db_path = db_path
+        self.names = names
+        self.poll_interval = poll_interval
+        self.debounce = debounce
+        self.stamp = self._stamp()
+        self.notifier = None
+        if pyinotify is not None:
+            manager = pyinotify.WatchManager()
+            self.notifier = pyinotify.Notifier(manager, lambda event: None)
+            mask = pyinotify.IN_MODIFY | pyinotify.IN_CLOSE_WRITE | pyinotify.IN_CREATE | pyinotify.IN_DELETE | \
+                pyinotify.IN_MOVED_TO | pyinotify.IN_MOVED_FROM
+            manager.add_watch(db_path, mask)
+        logger.info("Watch %s by %s", db_path, "inotify" if self.notifier else "polling")
+
+    def _stamp(self):
+        return database_stamp(self.db_path, self.names)
+
+    def _sleep(self, timeout):
+        """Wait for event of directory or for timeout"""
+        if self.notifier is None:
+            time.sleep(timeout)
+            return
+        if self.notifier.check_events(int(timeout * 1000)):
+            self.notifier.read_events()
+            self.notifier.process_events()
+
+    def wait(self):
+        """Wait until files are changed and aren't changed for debounce time
+
+        :return: time of first change
+        """
+        while True:
+            stamp = self._stamp()
+            if stamp != self.stamp:
+                break
+            self._sleep(self.poll_interval)
+        changed = last_change = time.time()
+        logger.info("Database is changed")
+        while True:
+            timeout = last_change + self.debounce - time.time()
+            if timeout <= 0:
+                break
+            self._sleep(min(timeout, self.poll_interval))
+            new_stamp = self._stamp()
+            if new_stamp != stamp:
+                stamp = new_stamp
+                last_change = time.time()
+        self.stamp = stamp
+        return changed
+
+    def close(self):
+        if self.notifier is not None:
+            self.notifier.stop()
+
+
+class WatchStats(object):
+    """Statistics of rebuilds
+
+    :ivar rebuilds: number of finished rebuilds
+    :ivar errors: number of failed rebuilds
+    :ivar last_build: seconds of last build
+    :ivar last_latency: seconds from change of database to end of last build
+    """
+
+    def __init__(self):
+        self.rebuilds = 0
+        self.errors = 0
+        self.last_build = None
+        self.last_latency = None
+        self.last_finished = None
+
+    def as_dict(self):
+        return {
+            "rebuilds": self.rebuilds,
+            "errors": self.errors,
+            "last_build": self.last_build,
+            "last_latency": self.last_latency,
+            "last_finished": self.last_finished,
+        }
+
+
+def watch(library, build, poll_interval=POLL_INTERVAL, debounce=DEBOUNCE, status_path=None):
+    """Build outputs and build them again on every change of databases of library until interruption
+
+    Library is kept open, only data which are read from it are dropped before rebuild.
+    Errors of rebuild are logged and watching is continued.
+
+    :param build: function to build outputs
+    :param status_path: path to write json of `WatchStats` after every build
+    """
+    watcher = Watcher(library.path, (library.LIBRARY_DB, library.IMAGE_PROXIES), poll_interval, debounce)
+    stats = WatchStats()
+    changed = time.time()
+    try:
+        while True:
+            start = time.time()
+            try:
+                build()
+            except Exception:
+                logger.exception("Build failed")
+                stats.errors += 1
+            else:
+                stats.rebuilds += 1
+            stats.last_finished = time.time()
+            stats.last_build = stats.last_finished - start
+            stats.last_latency = stats.last_finished - changed
+            logger.info("Build %d in %.3f s, %.3f s after change of database",
+                        stats.rebuilds, stats.last_build, stats.last_latency)
+            if status_path:
+                _write_status(status_path, stats)
+            changed = watcher.wait()
+            library.reset()
+    except KeyboardInterrupt:
+        logger.info("Stop watching")
+    finally:
+        watcher.close()
+    return stats
+
+
+def _write_status(status_path, stats):
+    tmp_status_path = status_path + ".tmp"
+    with open(tmp_status_path, "w") as status_file:
+        json.dump(stats.as_dict(), status_file, indent=2)
+    os.rename(tmp_status_path, status_path)